@@ -4,7 +4,6 @@ PROFESSIONAL_SKILLS_THRESHOLD = 0.1
 SOFT_SKILLS_THRESHOLD = 0.1
 
 DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT = 50
-THRESHOLD_STEP = 0.01
 
 DEFAULT_SKILL_TYPE_PROFESSIONAL = "Professional"
 DEFAULT_SKILL_TYPE_IT = "IT"
@@ -19,6 +18,124 @@ DISPLAY_SIMILAR_SKILLS_LIMIT = 10  # NEXT TO NEW SKILL
 
 BATCH_SIZE = 500  # LOADING FROM FILE
 
+# model the skill embeddings are encoded with; after a change the store is re-encoded in the background
+# and searches switch over once it has caught up
+EMBEDDING_MODEL_NAME = "multi-qa-mpnet-base-cos-v1"
+# model that encoded the stores written before stores recorded their model
+LEGACY_EMBEDDING_MODEL_NAME = "multi-qa-mpnet-base-cos-v1"
+EMBEDDING_CACHE_PATH = 'data1/embedding_cache.sqlite3'
+# vectors kept by the embedding cache; beyond this the least recently read ones are evicted
+EMBEDDING_CACHE_BYTES = 512 * 1024 * 1024
+# SQLite limits the number of host parameters in one statement, so key lookups go in chunks of this size
+SQLITE_QUERY_CHUNK_SIZE = 500
+# memory for query vectors kept by the in-process LRU in front of the embedding cache
+QUERY_EMBEDDING_CACHE_BYTES = 64 * 1024 * 1024
+
+# share of tombstoned rows that triggers a rewrite of an embedding store
+EMBEDDING_STORE_COMPACTION_RATIO = 0.25
+# log records (appended rows, deletes, retypes) past this share of the compacted rows trigger one as well, so
+# appended rows end up memory-mapped; a store's first EMBEDDING_STORE_MIN_LOG_RECORDS records never do
+EMBEDDING_STORE_LOG_RATIO = 0.5
+EMBEDDING_STORE_MIN_LOG_RECORDS = 1024
+# fsync store writes before acknowledging them; turning it off trades durability for speed
+EMBEDDING_STORE_FSYNC = True
+
+# precision of the in-memory copy used for scoring: "float32", "float16" or "int8";
+# compact modes re-rank RERANK_CANDIDATES_FACTOR times more candidates at full precision
+EMBEDDING_STORAGE_MODE = "float32"
+RERANK_CANDIDATES_FACTOR = 4
+
+# nearest-neighbour search over the embedding stores: "exact" or "hnsw" (needs hnswlib)
+VECTOR_INDEX_BACKEND = "exact"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 100
+HNSW_SAVE_EVERY = 1000  # ROWS ADDED BEFORE THE INDEX FILE IS REWRITTEN
+
+# exact search splits the store into this many row ranges scored in parallel threads; set it to the number
+# of cores on large stores. Stores are never split into ranges smaller than MIN_ROWS_PER_SEARCH_SHARD rows.
+SEARCH_SHARDS = 1
+MIN_ROWS_PER_SEARCH_SHARD = 20000
+
+# filter_skills fuses BM25 over skill titles and descriptions with the dense ranking (reciprocal rank fusion).
+# GPT gets as many candidates as with dense retrieval alone until a recall comparison shows fewer are enough.
+HYBRID_RETRIEVAL = True
+HYBRID_MAX_NUMBER_OF_SKILLS_FOR_GPT = 50
+HYBRID_CANDIDATES_PER_RETRIEVER = 50  # PER SKILL TYPE
+RRF_K = 60
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# a local cross-encoder matches extracted skills to the filtered candidates first; GPT only gets the skills it
+# is unsure about. A candidate is accepted when it scores at least CROSS_ENCODER_ACCEPT_SCORE and leads the
+# runner-up by CROSS_ENCODER_ACCEPT_MARGIN; a skill whose best candidate scores below CROSS_ENCODER_REJECT_SCORE
+# is new. Scores are the model's 0-1 similarities.
+LOCAL_SKILL_MATCHING = True
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/stsb-TinyBERT-L-4"
+CROSS_ENCODER_ACCEPT_SCORE = 0.8
+CROSS_ENCODER_ACCEPT_MARGIN = 0.1
+CROSS_ENCODER_REJECT_SCORE = 0.3
+CROSS_ENCODER_CANDIDATES_FOR_GPT = 10  # PER AMBIGUOUS SKILL
+
+# GPT responses are cached on disk by model, messages and parameters; entries expire after the TTL and the
+# least recently used ones are evicted beyond the size limit
+GPT_RESPONSE_CACHE_PATH = 'data1/gpt_response_cache.sqlite3'
+GPT_RESPONSE_CACHE_TTL = 30 * 24 * 60 * 60  # SECONDS
+GPT_RESPONSE_CACHE_BYTES = 256 * 1024 * 1024
+
+# course and profession files are loaded with the GPT calls of a whole batch running concurrently, at most
+# GPT_MAX_CONCURRENT_REQUESTS at a time; rows are still written to the graph in file order
+ASYNC_INGESTION = True
+# a new course is translated and its skills extracted in one structured GPT call instead of three; sentences the
+# translation memory already has are given to it in English instead of being translated again
+COMBINED_COURSE_PREPARATION = True
+GPT_MAX_CONCURRENT_REQUESTS = 8
+
+# requests are paced to the account's rate limits; set both to the limits of its usage tier. Token use is
+# estimated up front (prompt length plus GPT_COMPLETION_TOKENS_ESTIMATE) and corrected with the reported usage.
+# Rate limits, timeouts and server errors are retried up to GPT_MAX_RETRIES times with jittered exponential
+# backoff, never sooner than the API's retry-after.
+GPT_REQUESTS_PER_MINUTE = 500
+GPT_TOKENS_PER_MINUTE = 30000
+GPT_COMPLETION_TOKENS_ESTIMATE = 500
+GPT_MAX_RETRIES = 6
+GPT_RETRY_BASE_DELAY = 1.0  # SECONDS
+GPT_RETRY_MAX_DELAY = 60.0  # SECONDS
+# the API limits every model separately; (requests, tokens) per minute of models with other limits than the above
+GPT_RATE_LIMITS = {
+    'gpt-4o-mini': (500, 200000),
+}
+
+# model and generation parameters per GPTClient method; methods not listed use the client's model and the
+# API defaults. Translation and skill extraction are frequent and simple enough for the small model, matching
+# and the Finnish descriptions are not.
+GPT_MODEL_ROUTES = {
+    'translate': {'model': 'gpt-4o-mini', 'temperature': 0},
+    'prepare_course': {'model': 'gpt-4o-mini', 'temperature': 0},
+    'extract_skills_from_course_description': {'model': 'gpt-4o-mini', 'temperature': 0},
+    'extract_skills_from_profession_description': {'model': 'gpt-4o-mini', 'temperature': 0},
+    'match_skills_for_course': {'model': 'gpt-4o', 'temperature': 0},
+    'match_skills_for_profession': {'model': 'gpt-4o', 'temperature': 0},
+    'generate_skill_description_english': {'model': 'gpt-4o-mini'},
+    'generate_skill_description_finnish': {'model': 'gpt-4o'},
+}
+
+# token budgets for the variable context of GPT prompts; longer texts are cut to fit and ranked skill lists
+# lose their lowest-ranked skills. A match prompt gives its description at most a third of its budget.
+# Tokens are counted with tiktoken when it is installed and estimated from the length otherwise.
+GPT_PROMPT_TOKEN_BUDGETS = {
+    'generate_skill_description': 2000,
+    'translate': 8000,
+    'extract_skills': 8000,
+    'match_skills': 6000,
+}
+# every GPT call is logged here with its method, prompt and completion tokens and duration
+GPT_USAGE_LOG_PATH = 'data1/gpt_usage.jsonl'
+# translations of single sentences, reused whenever the same sentence comes up again
+TRANSLATION_MEMORY_PATH = 'data1/translation_memory.sqlite3'
+# sentences sent in one translate_many request
+TRANSLATE_MANY_BATCH_SIZE = 40
+
 skill_type_threshold = {
     DEFAULT_SKILL_TYPE_PROFESSIONAL: LANGUAGE_SKILLS_THRESHOLD,
     DEFAULT_SKILL_TYPE_IT: IT_SKILLS_THRESHOLD,
@@ -26,6 +143,17 @@ skill_type_threshold = {
     DEFAULT_SKILL_TYPE_LANGUAGE: LANGUAGE_SKILLS_THRESHOLD
 }
 
+# max number of skills of one type sent to GPT, e.g. {DEFAULT_SKILL_TYPE_LANGUAGE: 10};
+# types left out are only limited by DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT
+skill_type_quota = {}
+
+# skill embeddings of every type, kept in one store with a type code per row
+skill_embeddings_path_data = (
+    'data1/skill_embeddings.npy', 'data1/processed_skill_lines.npy', 'data1/title_skill_lines.npy')
+# names the model and files of the skill store in use; stores for other models get the model in their file names
+SKILL_EMBEDDINGS_ACTIVE_PATH = 'data1/skill_embeddings.active.json'
+
+# one store per skill type, as skills were kept before; imported into the store above on first use
 path_data = {
     DEFAULT_SKILL_TYPE_LANGUAGE: (
         'data1/Language_embeddings.npy', 'data1/processed_Language_lines.npy', 'data1/title_Language_lines.npy'),
@@ -39,6 +167,9 @@ path_data = {
     # 'Professions': ('data1/Professions_embeddings.npy', 'data1/processed_Professions_lines.npy', 'data1/title_Professions_lines.npy'),
 }
 
+# type code stored with every row of the skill store; codes must stay stable once rows are written
+skill_type_codes = {skill_type: code for code, skill_type in enumerate(path_data)}
+
 DEFAULT_NEW_SKILL_LABEL = "New_TN1"
 DEFAULT_SKILL_LABEL = "Original_TN1"
 DEFAULT_PROFESSION_LABEL = "Profession_TEST_N"
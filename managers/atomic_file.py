@@ -0,0 +1,25 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from constants import EMBEDDING_STORE_FSYNC
+
+
+@contextmanager
+def atomic_write(file_path, mode='wb', encoding=None, fsync=EMBEDDING_STORE_FSYNC):
+    # Yields a temporary file of its own next to file_path and moves it into place once written, so readers never
+    # see a partial file and instances writing the same file at the same time never share a temporary file.
+    directory = os.path.dirname(file_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file = tempfile.NamedTemporaryFile(mode, encoding=encoding, dir=directory,
+                                       prefix=f"{os.path.basename(file_path)}.", suffix='.tmp', delete=False)
+    try:
+        with file:
+            yield file
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+        os.replace(file.name, file_path)
+    except BaseException:
+        if os.path.exists(file.name):
+            os.remove(file.name)
+        raise
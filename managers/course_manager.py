@@ -1,19 +1,21 @@
+import asyncio
 import pandas as pd
 from py2neo import Node, Relationship, NodeMatcher
+from services.GPTClient import AsyncGPTClient
+from managers.thread_warnings import to_thread_with_warnings
 from constants import *
 
 
 class CourseManager:
-    def __init__(self, graph, gpt_client, embedding_manager, skill_manager):
+    def __init__(self, graph, gpt_client, embedding_manager, skill_manager, skill_matcher):
         self.graph = graph
         self.gpt_client = gpt_client
         self.embedding_manager = embedding_manager
         self.skill_manager = skill_manager
+        self.skill_matcher = skill_matcher
         self.matcher = NodeMatcher(graph)
 
-    def add_course(self, course_title_fi, course_title="", course_description="", course_description_fi="",
-                   course_source_code="", course_location="", course_skills="", warnings_fn=None):
-
+    def course_exists(self, course_title_fi, course_description_fi, course_source_code, warnings_fn=None):
         title_description_fi = f"{course_title_fi}::{course_description_fi}"
         existing_course = self.matcher.match(DEFAULT_COURSE_LABEL, source_code=course_source_code,
                                              title_fi=course_title_fi).first()
@@ -26,7 +28,19 @@ class CourseManager:
             print(message)
             if warnings_fn:
                 warnings_fn(message)
+            return True
+        return False
+
+    def add_course(self, course_title_fi, course_title="", course_description="", course_description_fi="",
+                   course_source_code="", course_location="", course_skills="", warnings_fn=None):
+
+        if self.course_exists(course_title_fi, course_description_fi, course_source_code, warnings_fn):
             return
+        if COMBINED_COURSE_PREPARATION and not (course_title or course_description or course_skills):
+            # Falls back to the separate calls below if the combined one fails
+            course_title, course_description, course_skills = (
+                self.gpt_client.prepare_course(course_title_fi, course_description_fi, warnings_fn=warnings_fn)
+                or ("", "", ""))
         if not course_title:
             course_title = self.gpt_client.translate(course_title_fi)
         if not course_description:
@@ -35,6 +49,68 @@ class CourseManager:
         if not course_skills:
             course_skills = self.gpt_client.extract_skills_from_course_description(f"{course_title}::{course_description}")
 
+        # self.embedding_manager.add_to_embeddings(course_title, skills, 'Courses', warnings_fn=warnings_fn)
+
+        filtered_skills = self.embedding_manager.filter_skills(course_title, course_skills,
+                                                               warnings_fn=warnings_fn)
+
+        matched_skills = self.skill_matcher.match_skills_for_course(filtered_skills,
+                                                                    f"{course_title}::{course_skills}",
+                                                                    warnings_fn=warnings_fn)
+        if matched_skills is None:
+            self.report_unmatched_course(course_title_fi, warnings_fn)
+            return
+
+        self.create_course(course_title, course_description, course_skills, course_source_code, course_location,
+                           course_title_fi, course_description_fi, matched_skills, warnings_fn)
+
+    async def prepare_course_async(self, async_gpt_client, course_title_fi, course_title="", course_description_fi="",
+                                   course_source_code="", course_location="", warnings_fn=None):
+        # Everything add_course does before it writes to the graph, with the GPT calls awaited so that other
+        # courses proceed meanwhile. Returns the arguments of create_course, or None for existing courses and for
+        # courses whose skills could not be matched.
+        if await to_thread_with_warnings(self.course_exists, course_title_fi, course_description_fi,
+                                         course_source_code, warnings_fn=warnings_fn):
+            return None
+
+        prepared_course = None
+        if COMBINED_COURSE_PREPARATION and not course_title:
+            prepared_course = await async_gpt_client.prepare_course(course_title_fi, course_description_fi,
+                                                                    warnings_fn=warnings_fn)
+        if prepared_course:
+            course_title, course_description, course_skills = prepared_course
+        else:
+            course_title, course_description = await asyncio.gather(
+                self.translate_if_missing(async_gpt_client, course_title, course_title_fi),
+                async_gpt_client.translate(course_description_fi))
+            course_skills = await async_gpt_client.extract_skills_from_course_description(
+                f"{course_title}::{course_description}")
+
+        filtered_skills = await to_thread_with_warnings(self.embedding_manager.filter_skills, course_title,
+                                                        course_skills, warnings_fn=warnings_fn)
+        matched_skills = await self.skill_matcher.match_skills_for_course_async(
+            filtered_skills, f"{course_title}::{course_skills}", async_gpt_client, warnings_fn=warnings_fn)
+        if matched_skills is None:
+            self.report_unmatched_course(course_title_fi, warnings_fn)
+            return None
+
+        return (course_title, course_description, course_skills, course_source_code, course_location,
+                course_title_fi, course_description_fi, matched_skills)
+
+    @staticmethod
+    def report_unmatched_course(course_title_fi, warnings_fn=None):
+        # The course is not created, so the next import of the file tries it again
+        message = f"Skills of course {course_title_fi} could not be matched; the course was not added."
+        print(message)
+        if warnings_fn:
+            warnings_fn(message)
+
+    @staticmethod
+    async def translate_if_missing(async_gpt_client, translation, text):
+        return translation or await async_gpt_client.translate(text)
+
+    def create_course(self, course_title, course_description, course_skills, course_source_code, course_location,
+                      course_title_fi, course_description_fi, matched_skills, warnings_fn=None):
         course_node = Node(DEFAULT_COURSE_LABEL,
                            title=course_title,
                            description=course_description,
@@ -47,19 +123,16 @@ class CourseManager:
 
         self.graph.create(course_node)
 
-        # self.embedding_manager.add_to_embeddings(course_title, skills, 'Courses', warnings_fn=warnings_fn)
-
-        filtered_skills = self.embedding_manager.filter_skills(course_title, course_skills,
-                                                               warnings_fn=warnings_fn)
-
-        matched_skills = self.gpt_client.match_skills_for_course(filtered_skills, f"{course_title}::{course_skills}")
+        # Skills without a matching candidate are resolved against the embeddings in one batch
+        resolved_new_skills = iter(self.skill_manager.handle_new_skills(
+            [pair['extracted_skill'] for pair in matched_skills if pair['common_skill'].lower() == 'new']))
 
         for pair in matched_skills:
             extracted_skill = pair['extracted_skill']
             matched_skill = pair['common_skill']
 
             if matched_skill.lower() == 'new':
-                matched_skill, relationship_type = self.skill_manager.handle_new_skill(extracted_skill)
+                matched_skill, relationship_type = next(resolved_new_skills)
             else:
                 relationship_type = f"EXCT [{extracted_skill}]"
 
@@ -79,15 +152,58 @@ class CourseManager:
                     warnings_fn(message)
 
     def add_courses_batch(self, courses_batch, warnings_fn=None):
-        for course_data in courses_batch:
+        if ASYNC_INGESTION:
+            asyncio.run(self.add_courses_batch_async(courses_batch, warnings_fn))
+            return
+
+        for course_data, course_title in zip(courses_batch, self.translate_titles(courses_batch)):
             self.add_course(
                 course_title_fi=course_data['course_title_fi'],
+                course_title=course_title,
                 course_description_fi=course_data['course_description_fi'],
                 course_source_code=course_data['course_source_code'],
                 course_location=course_data['course_location'],
                 warnings_fn=warnings_fn
             )
 
+    def translate_titles(self, courses_batch):
+        # Titles are short and often repeated, so a whole batch of them goes to GPT in a few requests.
+        # The combined preparation translates them anyway, so it gets no titles.
+        if COMBINED_COURSE_PREPARATION:
+            return [""] * len(courses_batch)
+        return [course_title or "" for course_title in self.gpt_client.translate_many(
+            [course_data['course_title_fi'] for course_data in courses_batch])]
+
+    async def add_courses_batch_async(self, courses_batch, warnings_fn=None):
+        # The courses of the batch are prepared concurrently and written to the graph in batch order
+        async with AsyncGPTClient(self.gpt_client) as async_gpt_client:
+            course_titles = [""] * len(courses_batch)
+            if not COMBINED_COURSE_PREPARATION:
+                course_titles = [course_title or "" for course_title in await async_gpt_client.translate_many(
+                    [course_data['course_title_fi'] for course_data in courses_batch])]
+            prepared_courses = await asyncio.gather(*(
+                self.prepare_course_async(
+                    async_gpt_client,
+                    course_title_fi=course_data['course_title_fi'],
+                    course_title=course_title,
+                    course_description_fi=course_data['course_description_fi'],
+                    course_source_code=course_data['course_source_code'],
+                    course_location=course_data['course_location'],
+                    warnings_fn=warnings_fn
+                ) for course_data, course_title in zip(courses_batch, course_titles)), return_exceptions=True)
+
+        for course_data, prepared_course in zip(courses_batch, prepared_courses):
+            if isinstance(prepared_course, Exception):
+                message = f"Failed to add course {course_data['course_title_fi']}: {prepared_course}"
+                print(message)
+                if warnings_fn:
+                    warnings_fn(message)
+            # The same course may appear twice in one batch
+            elif prepared_course is not None and not self.course_exists(
+                    course_data['course_title_fi'], course_data['course_description_fi'],
+                    course_data['course_source_code'], warnings_fn):
+                self.create_course(*prepared_course, warnings_fn=warnings_fn)
+
     def load_courses_from_file(self, file_path, batch_size=BATCH_SIZE, warnings_fn=None, progress_fn=None):
 
         try:
@@ -2,6 +2,7 @@ from py2neo import Graph, Relationship
 from managers.embedding_manager import EmbeddingManager
 from services.GPTClient import GPTClient
 from managers.skill_manager import SkillManager
+from managers.skill_matcher import SkillMatcher
 from managers.course_manager import CourseManager
 from managers.profession_manager import ProfessionManager
 from managers.person_manager import PersonManager
@@ -17,9 +18,11 @@ class DatabaseManager:
         self.embedding_manager = EmbeddingManager()
         self.gpt_client = GPTClient()  # Define warning function if needed
         self.skill_manager = SkillManager(self.graph, self.embedding_manager, self.gpt_client)
-        self.course_manager = CourseManager(self.graph, self.gpt_client, self.embedding_manager, self.skill_manager)
+        self.skill_matcher = SkillMatcher(self.gpt_client)
+        self.course_manager = CourseManager(self.graph, self.gpt_client, self.embedding_manager, self.skill_manager,
+                                            self.skill_matcher)
         self.profession_manager = ProfessionManager(self.graph, self.gpt_client, self.embedding_manager,
-                                                    self.skill_manager)
+                                                    self.skill_manager, self.skill_matcher)
         self.person_manager = PersonManager(self.graph, self.skill_manager)
 
     def get_all_skills(self, warnings_fn=None):
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+import numpy as np
+from constants import SQLITE_QUERY_CHUNK_SIZE
+
+
+class EmbeddingCache:
+    """Persistent cache of model outputs keyed by a hash of the model name and the encoded text.
+
+    When the stored vectors take more than ``max_bytes``, the least recently read ones are evicted.
+    """
+
+    def __init__(self, file_path, model_name, max_bytes):
+        self.file_path = file_path
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dim INTEGER, vector BLOB, accessed REAL)")
+            if 'accessed' not in {column[1] for column in connection.execute("PRAGMA table_info(embeddings)")}:
+                # Caches written before eviction; their vectors count as read now
+                connection.execute("ALTER TABLE embeddings ADD COLUMN accessed REAL")
+                connection.execute("UPDATE embeddings SET accessed = ?", (time.time(),))
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        keys = {self.key(text): text for text in texts}
+        found = {}
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            key_list = list(keys)
+            found_keys = []
+            for start in range(0, len(key_list), SQLITE_QUERY_CHUNK_SIZE):
+                chunk = key_list[start:start + SQLITE_QUERY_CHUNK_SIZE]
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, vector in rows:
+                    found[keys[key]] = np.frombuffer(vector, dtype='<f4')
+                    found_keys.append(key)
+            now = time.time()
+            connection.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?",
+                                   [(now, key) for key in found_keys])
+        return found
+
+    def put_many(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype='<f4').reshape(len(texts), -1)
+        now = time.time()
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, accessed) VALUES (?, ?, ?, ?)",
+                [(self.key(text), vectors.shape[1], vector.tobytes(), now) for text, vector in zip(texts, vectors)])
+            self._evict(connection)
+
+    def _evict(self, connection):
+        # Vectors are float32, so a row takes 4 * dim bytes
+        total_size = connection.execute("SELECT COALESCE(SUM(dim), 0) * 4 FROM embeddings").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        # Least recently read first, until the rest fits
+        evicted = []
+        for key, dim in connection.execute("SELECT key, dim FROM embeddings ORDER BY accessed"):
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= 4 * dim
+        connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+
+
+class QueryEmbeddingCache:
+    """In-memory LRU of query vectors keyed by preprocessed text, bounded by the bytes the vectors take."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def get(self, text):
+        with self._lock:
+            vector = self._vectors.get(text)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._vectors.move_to_end(text)
+            self.hits += 1
+            return vector
+
+    def put(self, text, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.nbytes > self.max_bytes:
+            return
+        # Callers share the cached array, so it must not be changed in place.
+        vector.setflags(write=False)
+        with self._lock:
+            previous = self._vectors.pop(text, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self._vectors[text] = vector
+            self.size += vector.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self._vectors.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._vectors), 'bytes': self.size}
+
+
+_query_embedding_caches = {}
+_query_embedding_caches_lock = threading.Lock()
+
+
+def query_embedding_cache(model_name, max_bytes):
+    # One LRU per model for the whole process: Streamlit builds new managers on every rerun, and those reruns
+    # are where the cached queries come back.
+    with _query_embedding_caches_lock:
+        if model_name not in _query_embedding_caches:
+            _query_embedding_caches[model_name] = QueryEmbeddingCache(max_bytes)
+        return _query_embedding_caches[model_name]
@@ -1,16 +1,195 @@
+import functools
+import json
 import os
 import re
+import threading
 import numpy as np
 from nltk.corpus import stopwords
-from sentence_transformers import util, SentenceTransformer
-from constants import path_data, skill_type_threshold, DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT, THRESHOLD_STEP
+from sentence_transformers import SentenceTransformer
+from managers.embedding_cache import EmbeddingCache, query_embedding_cache
+from managers.embedding_store import EmbeddingStore, file_stamp
+from managers.atomic_file import atomic_write
+from managers.vector_index import create_vector_index
+from managers.lexical_index import bm25_index
+from managers.skill_selection import select_skills, reciprocal_rank_fusion
+from constants import path_data, skill_embeddings_path_data, skill_type_codes, skill_type_threshold, \
+    skill_type_quota, DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT, EMBEDDING_MODEL_NAME, LEGACY_EMBEDDING_MODEL_NAME, \
+    EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_BYTES, QUERY_EMBEDDING_CACHE_BYTES, BATCH_SIZE, HYBRID_RETRIEVAL, \
+    HYBRID_MAX_NUMBER_OF_SKILLS_FOR_GPT, HYBRID_CANDIDATES_PER_RETRIEVER, SKILL_EMBEDDINGS_ACTIVE_PATH
+
+
+def encode_cached(model, embedding_cache, texts):
+    # Reads vectors for already seen texts from the cache and encodes the rest in one model call
+    single = isinstance(texts, str)
+    texts = [texts] if single else list(texts)
+
+    vectors = embedding_cache.get_many(texts)
+    missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+    if missing:
+        encoded = model.encode(missing)
+        embedding_cache.put_many(missing, encoded)
+        vectors.update(zip(missing, np.asarray(encoded, dtype=np.float32).reshape(len(missing), -1)))
+
+    if single:
+        return vectors[texts[0]]
+    return np.stack([vectors[text] for text in texts]) if texts else np.empty((0, 0), dtype=np.float32)
+
+
+def model_store_paths(model_name):
+    # Store files for vectors of model_name, next to the ones of the legacy model
+    slug = re.sub(r'[^\w.-]+', '_', model_name)
+    return tuple(f"{root}.{slug}{extension}" for root, extension in map(os.path.splitext, skill_embeddings_path_data))
+
+
+def read_active_store():
+    # The model and files of the store that serves searches; stores from before models were tracked are the
+    # legacy model's store under the plain file names.
+    try:
+        with open(SKILL_EMBEDDINGS_ACTIVE_PATH, encoding='utf-8') as active_file:
+            active = json.load(active_file)
+        return active['model'], tuple(active['paths'])
+    except FileNotFoundError:
+        return LEGACY_EMBEDDING_MODEL_NAME, skill_embeddings_path_data
+
+
+def write_active_store(model_name, paths):
+    with atomic_write(SKILL_EMBEDDINGS_ACTIVE_PATH, 'w', encoding='utf-8', fsync=True) as active_file:
+        json.dump({'model': model_name, 'paths': list(paths)}, active_file)
+
+
+def writes_to_active_store(method):
+    # Writes go to the store that is active when they run, never to one a re-encode is about to retire
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._swap_lock:
+            self.refresh_active_store()
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class EmbeddingManager:
     stop_words = set(stopwords.words('english'))
 
     def __init__(self):
-        self.model = SentenceTransformer("multi-qa-mpnet-base-cos-v1")
+        self._swap_lock = threading.RLock()
+        self._active_stamp = None
+        self._reencode_thread = None
+        self.model_name = None
+        self.refresh_active_store()
+        if self.model_name != EMBEDDING_MODEL_NAME:
+            # The old store keeps serving until the new one has caught up
+            self.reencode_in_background(EMBEDDING_MODEL_NAME)
+
+    @property
+    def model(self):
+        return self._encoder[0]
+
+    @property
+    def embedding_cache(self):
+        return self._encoder[1]
+
+    def refresh_active_store(self):
+        # Follows the active-store pointer, which a re-encode in this or another process moves to a new model
+        with self._swap_lock:
+            stamp = file_stamp(SKILL_EMBEDDINGS_ACTIVE_PATH)
+            if self.model_name is not None and stamp == self._active_stamp:
+                return
+            model_name, paths = read_active_store()
+            if model_name != self.model_name or paths != self.store.paths:
+                self._activate(model_name, SentenceTransformer(model_name), EmbeddingStore(*paths))
+            self._active_stamp = stamp
+
+    def _activate(self, model_name, model, store):
+        if not store.exists() and model_name == LEGACY_EMBEDDING_MODEL_NAME:
+            self.import_stores_by_type(store)
+
+        model_tag = store.model_tag()
+        if model_tag is None:
+            store.tag(model_name, store.dim or model.get_sentence_embedding_dimension())
+        elif model_tag['model'] != model_name:
+            raise RuntimeError(f"{store.embeddings_file_path} holds vectors of {model_tag['model']}, not {model_name}.")
+
+        # One assignment, so a concurrent encode never pairs one model with the other's cache
+        self._encoder = (model, EmbeddingCache(EMBEDDING_CACHE_PATH, model_name, EMBEDDING_CACHE_BYTES))
+        self.model_name = model_name
+        self.query_cache = query_embedding_cache(model_name, QUERY_EMBEDDING_CACHE_BYTES)
+        self.store = store
+        self.index = create_vector_index(store)
+        self.lexical_index = bm25_index(store)
+
+    def reencode_in_background(self, model_name):
+        with self._swap_lock:
+            if self._reencode_thread is None or not self._reencode_thread.is_alive():
+                self._reencode_thread = threading.Thread(target=self.reencode, args=(model_name,), daemon=True)
+                self._reencode_thread.start()
+            return self._reencode_thread
+
+    def reencode(self, model_name, max_passes=3):
+        # Builds a store for model_name next to the active one in batches, while the active one keeps serving.
+        # Every pass only encodes what changed since the previous one; the last pass runs with writes blocked,
+        # after which the new store is made active and the old one retired. Managers in this and other
+        # processes start re-encodes of their own; the target's rebuild lock lets only one of them run.
+        try:
+            target = EmbeddingStore(*model_store_paths(model_name))
+            with target.rebuild_lock() as locked:
+                if not locked:
+                    print(f"Skill embeddings are already being re-encoded with {model_name}.")
+                    return
+                self.refresh_active_store()
+                if self.model_name == model_name:
+                    # Another re-encode finished while this one was starting
+                    return
+                self._reencode(model_name, target, max_passes)
+
+        except Exception as e:
+            print(f"Failed to re-encode skill embeddings with {model_name}: {e}")
+
+    def _reencode(self, model_name, target, max_passes):
+        model = SentenceTransformer(model_name)
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, model_name, EMBEDDING_CACHE_BYTES)
+        if target.model_tag() is None:
+            target.tag(model_name, model.get_sentence_embedding_dimension())
+
+        def encode(texts):
+            return encode_cached(model, embedding_cache, texts)
+
+        for _ in range(max_passes):
+            report = self.sync_store(target, self.store.entries(), encode)
+            print(f"Re-encoding with {model_name}: {len(report['added'])} skills added.")
+            if not report['added'] and not report['deleted']:
+                break
+        target.compact_if_needed()
+
+        with self._swap_lock:
+            source = self.store
+            with source.locked():
+                self.sync_store(target, source.entries(), encode)
+                write_active_store(model_name, target.paths)
+                source.retire()
+            self._activate(model_name, model, target)
+            self._active_stamp = file_stamp(SKILL_EMBEDDINGS_ACTIVE_PATH)
+        print(f"Skill embeddings now use {model_name}.")
+
+    def import_stores_by_type(self, store):
+        # Skills used to be kept in one store per type; their live rows are copied into the single store once.
+        # The store lock is held from the check to the last row, so managers starting at the same time in other
+        # threads or processes import them only once.
+        with store.locked():
+            if store.exists():
+                return
+            for path_key, file_paths in path_data.items():
+                type_store = EmbeddingStore(*file_paths, storage_mode='float32')
+                rows = np.flatnonzero(type_store.alive())
+                if len(rows):
+                    store.add_many(type_store.embeddings()[rows], [type_store.processed_lines[row] for row in rows],
+                                   [type_store.title(row) for row in rows], [skill_type_codes[path_key]] * len(rows))
+                    print(f"{len(rows)} {path_key} skills imported into {store.embeddings_file_path}.")
+        # Outside the lock: a compaction started in the background by the import needs it to finish
+        store.compact_if_needed()
+
+    def compact_store(self):
+        # Called at the end of an import, so the rows it appended are memory-mapped from the next load on
+        self.store.compact_if_needed()
 
     @staticmethod
     def preprocess_text(text):
@@ -22,6 +201,38 @@ class EmbeddingManager:
         text = " ".join(word for word in text.split() if word not in EmbeddingManager.stop_words)
         return text
 
+    @staticmethod
+    def build_title_description(title, description):
+        processed_title = EmbeddingManager.preprocess_text(title)
+        processed_description = EmbeddingManager.preprocess_text(description)
+        return f"{processed_title or ''}::{processed_description or ''}"
+
+    def encode(self, texts):
+        return encode_cached(*self._encoder, texts)
+
+    def encode_query(self, text):
+        # Search targets repeat across an import and across Streamlit reruns, so they are kept in memory
+        vector = self.query_cache.get(text)
+        if vector is None:
+            vector = self.encode(text)
+            self.query_cache.put(text, vector)
+        return vector
+
+    def encode_queries(self, texts):
+        vectors = {}
+        for text in texts:
+            vector = self.query_cache.get(text)
+            if vector is not None:
+                vectors[text] = vector
+
+        missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+        if missing:
+            for text, vector in zip(missing, self.encode(missing)):
+                self.query_cache.put(text, vector)
+                vectors[text] = vector
+        return np.stack([vectors[text] for text in texts])
+
+    @writes_to_active_store
     def add_to_embeddings(self, title, description, path_key, warnings_fn=None):
         if path_key not in path_data:
             message = "Invalid path key provided."
@@ -29,56 +240,78 @@ class EmbeddingManager:
                 warnings_fn(message)
             return
 
-        processed_title = self.preprocess_text(title)
-        processed_description = self.preprocess_text(description)
-        embeddings_file_path, processed_lines_file_path, title_lines_file_path = path_data[path_key]
-
-        os.makedirs(os.path.dirname(embeddings_file_path), exist_ok=True)
-        os.makedirs(os.path.dirname(processed_lines_file_path), exist_ok=True)
-        os.makedirs(os.path.dirname(title_lines_file_path), exist_ok=True)
-
-        title_description = f"{processed_title or ''}::{processed_description or ''}"
-
-        embedding = self.model.encode(title_description)
+        title_description = self.build_title_description(title, description)
+        store = self.store
 
-        if all(os.path.exists(file_path) for file_path in
-               [embeddings_file_path, processed_lines_file_path, title_lines_file_path]):
-            try:
-                embeddings = np.load(embeddings_file_path, allow_pickle=True)
-                processed_lines = np.load(processed_lines_file_path, allow_pickle=True).tolist()
-                title_lines = np.load(title_lines_file_path, allow_pickle=True).tolist()
-            except Exception as e:
-                if warnings_fn:
-                    warnings_fn(f"Error loading files: {e}")
-                return
-
-            if title_description in processed_lines:
+        try:
+            if store.find(title_description) is not None:
                 message = f"'{title_description}' already exists in embeddings."
                 if warnings_fn:
                     warnings_fn(message)
                 return
-            else:
-                embeddings = np.vstack((embeddings, embedding))
-                processed_lines.append(title_description)
-                title_lines.append(title)
-        else:
-            embeddings = embedding
-            processed_lines = [title_description]
-            title_lines = [title]
+        except Exception as e:
+            if warnings_fn:
+                warnings_fn(f"Error loading files: {e}")
+            return
+
+        embedding = self.encode(title_description)
 
         try:
-            np.save(embeddings_file_path, embeddings, allow_pickle=True)
-            np.save(processed_lines_file_path, processed_lines, allow_pickle=True)
-            np.save(title_lines_file_path, title_lines, allow_pickle=True)
+            row = store.add(embedding, title_description, title, skill_type_codes[path_key])
             if warnings_fn:
                 warnings_fn(f"'{title_description}' added to embeddings.")
 
+        except Exception as e:
+            if warnings_fn:
+                warnings_fn(f"Error saving files: {e}")
+            return
+
+        return row
+
+    @writes_to_active_store
+    def add_to_embeddings_batch(self, skills, warnings_fn=None):
+        # skills: iterable of (title, description, path_key). Everything new is encoded with a single
+        # model call and written with one append. Returns the row id of every skill, or None for the
+        # ones that were skipped.
+        skills = list(skills)
+        rows = [None] * len(skills)
+        store_lines, store_titles, store_types, positions = [], [], [], []
+        seen = set()
+        for position, (title, description, path_key) in enumerate(skills):
+            if path_key not in path_data:
+                if warnings_fn:
+                    warnings_fn("Invalid path key provided.")
+                continue
+
+            title_description = self.build_title_description(title, description)
+            if title_description in seen or self.store.find(title_description) is not None:
+                if warnings_fn:
+                    warnings_fn(f"'{title_description}' already exists in embeddings.")
+                continue
+
+            seen.add(title_description)
+            store_lines.append(title_description)
+            store_titles.append(title)
+            store_types.append(skill_type_codes[path_key])
+            positions.append(position)
+
+        if not store_lines:
+            return rows
+        embeddings = self.encode(store_lines)
+
+        try:
+            for position, row in zip(positions, self.store.add_many(embeddings, store_lines, store_titles,
+                                                                    store_types)):
+                rows[position] = row
+            if warnings_fn:
+                warnings_fn(f"{len(store_lines)} skills added to embeddings.")
         except Exception as e:
             if warnings_fn:
                 warnings_fn(f"Error saving files: {e}")
 
-        return True
+        return rows
 
+    @writes_to_active_store
     def delete_from_embeddings(self, title, description, path_key, warnings_fn=None):
         if path_key not in path_data:
             message = "Invalid path key provided."
@@ -86,112 +319,198 @@ class EmbeddingManager:
                 warnings_fn(message)
             return
 
-        processed_title = self.preprocess_text(title)
-        processed_description = self.preprocess_text(description)
-
-        title_description = f"{processed_title or ''}::{processed_description or ''}"
-
-        embeddings_file_path, processed_lines_file_path, title_lines_file_path = path_data[path_key]
+        title_description = self.build_title_description(title, description)
+        store = self.store
 
-        if all(os.path.exists(file_path) for file_path in
-               [embeddings_file_path, processed_lines_file_path, title_lines_file_path]):
+        # The row is checked and deleted under the store lock, so a compaction cannot renumber it in between
+        with store.locked():
             try:
-                embeddings = np.load(embeddings_file_path, allow_pickle=True)
-                processed_lines = np.load(processed_lines_file_path, allow_pickle=True).tolist()
-                title_lines = np.load(title_lines_file_path, allow_pickle=True).tolist()
-
+                row = store.find(title_description)
             except Exception as e:
                 if warnings_fn:
                     warnings_fn(f"Error loading files: {e}")
                 return
 
-            if title_description not in processed_lines:
-                message = f"'{title_description}' does not exist in embeddings."
+            if not len(store):
+                message = "Embeddings file or processed lines file does not exist."
                 if warnings_fn:
                     warnings_fn(message)
                 return
 
-            index = processed_lines.index(title_description)
-            embeddings = np.delete(embeddings, index, axis=0)
-            processed_lines.pop(index)
-            title_lines.pop(index)
+            if row is None or store.type(row) != skill_type_codes[path_key]:
+                message = f"'{title_description}' does not exist in embeddings."
+                if warnings_fn:
+                    warnings_fn(message)
+                return
 
             try:
-                np.save(embeddings_file_path, embeddings)
-                np.save(processed_lines_file_path, processed_lines, allow_pickle=True)
-                np.save(title_lines_file_path, title_lines, allow_pickle=True)
-
+                store.delete(title_description)
             except Exception as e:
                 if warnings_fn:
                     warnings_fn(f"Error saving files: {e}")
+                return
 
-            if warnings_fn:
-                warnings_fn(f"'{title_description}' deleted from embeddings.")
-        else:
-            message = "Embeddings file or processed lines file does not exist."
-            if warnings_fn:
-                warnings_fn(message)
+        if warnings_fn:
+            warnings_fn(f"'{title_description}' deleted from embeddings.")
+        return row
 
+    @writes_to_active_store
     def update_embeddings(self, old_title, old_description, new_title, new_description, old_path_key, new_path_key=None,
                           warnings_fn=None):
-        self.delete_from_embeddings(old_title, old_description, old_path_key, warnings_fn)
         if new_path_key is None:
             new_path_key = old_path_key
+
+        # A skill that only changes type keeps its row and vector
+        title_description = self.build_title_description(old_title, old_description)
+        if old_title == new_title and title_description == self.build_title_description(new_title, new_description) \
+                and old_path_key in path_data and new_path_key in path_data:
+            try:
+                with self.store.locked():
+                    row = self.store.find(title_description)
+                    if row is not None and self.store.type(row) == skill_type_codes[old_path_key]:
+                        self.store.retype(title_description, skill_type_codes[new_path_key])
+                        if warnings_fn:
+                            warnings_fn(
+                                f"'{title_description}' moved from {old_path_key} to {new_path_key} embeddings.")
+                        return
+            except Exception as e:
+                if warnings_fn:
+                    warnings_fn(f"Error saving files: {e}")
+                return
+
+        self.delete_from_embeddings(old_title, old_description, old_path_key, warnings_fn)
         self.add_to_embeddings(new_title, new_description, new_path_key, warnings_fn)
 
+    @writes_to_active_store
+    def reconcile_embeddings(self, skills, warnings_fn=None):
+        # skills: iterable of (title, description, path_key) for every skill the store should hold, e.g. streamed
+        # from the graph. Returns what was changed.
+        invalid = []
+
+        def entries():
+            for title, description, path_key in skills:
+                if path_key not in path_data:
+                    invalid.append(title)
+                    continue
+                yield self.build_title_description(title, description), title, skill_type_codes[path_key]
+
+        report = self.sync_store(self.store, entries(), self.encode)
+        report['skipped'].extend(invalid)
+        return report
+
+    @staticmethod
+    def sync_store(store, entries, encode):
+        # entries: (processed line, title, type code) of every row store should hold. Rows are matched on the
+        # hash of their processed line, so only missing or changed entries get encoded. Returns what was changed.
+        # Matches are kept by processed line: a compaction during the stream may renumber the rows.
+        report = {'added': [], 'retyped': [], 'deleted': [], 'unchanged': 0, 'skipped': []}
+        matched_lines = set()
+        missing = {}
+        for processed_line, title, type_code in entries:
+            row = store.find(processed_line)
+            if processed_line in matched_lines or processed_line in missing:
+                # Another entry with the same processed text already claimed the row
+                report['skipped'].append(title)
+            elif row is None or store.title(row) != title:
+                missing[processed_line] = (title, type_code)
+            else:
+                matched_lines.add(processed_line)
+                if store.type(row) != type_code:
+                    store.retype(processed_line, type_code)
+                    report['retyped'].append(title)
+                else:
+                    report['unchanged'] += 1
+
+        # Rows no entry matched belong to deleted entries or to an older title or description. They are
+        # looked up and deleted under the store lock, so no compaction can renumber them in between.
+        with store.locked():
+            stale = [(processed_line, title) for processed_line, title, _ in store.entries()
+                     if processed_line not in matched_lines]
+            store.delete_many(processed_line for processed_line, _ in stale)
+        report['deleted'] = [title for _, title in stale]
+
+        missing = list(missing.items())
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = missing[start:start + BATCH_SIZE]
+            processed_lines = [processed_line for processed_line, _ in batch]
+            titles = [title for _, (title, _) in batch]
+            store.add_many(encode(processed_lines), processed_lines, titles, [type_code for _, (_, type_code) in batch])
+            report['added'].extend(titles)
+
+        return report
+
+    def search_by_type(self, target_embedding, top_k_by_path_key):
+        # Rows are mapped to titles with the snapshot they were found in, so a compaction finishing meanwhile
+        # cannot pair a score with another row's title
+        snapshot = self.store.snapshot()
+        results = self.index.search_by_type(
+            target_embedding, {skill_type_codes[path_key]: top_k for path_key, top_k in top_k_by_path_key.items()},
+            snapshot)
+        return {path_key: [(snapshot.title(row), score) for row, score in results[skill_type_codes[path_key]]]
+                for path_key in top_k_by_path_key}
+
+    def hybrid_search_by_type(self, processed_text, target_embedding, snapshot):
+        # Dense candidates at or below the threshold of their type are dropped, as in dense-only retrieval;
+        # they and the BM25 hits are then ranked by reciprocal rank fusion. Returns (row, fused score) pairs
+        # of rows in snapshot.
+        top_k_by_type = {skill_type_codes[path_key]: HYBRID_CANDIDATES_PER_RETRIEVER for path_key in path_data}
+        dense_results = self.index.search_by_type(target_embedding, top_k_by_type, snapshot)
+        lexical_results = self.lexical_index.search_by_type(processed_text, top_k_by_type, snapshot)
+
+        candidates = {}
+        for path_key in path_data:
+            type_code = skill_type_codes[path_key]
+            threshold = skill_type_threshold.get(path_key, 0.0)
+            fused = reciprocal_rank_fusion([[row for row, score in dense_results[type_code] if score > threshold],
+                                            [row for row, _ in lexical_results[type_code]]])
+            candidates[path_key] = sorted(fused.items(), key=lambda pair: (-pair[1], pair[0]))
+        return candidates
+
+    def similarities(self, title, description, skills):
+        # Similarity of every (title, description) in skills to one skill, scored as the index scores its rows
+        vector = self.encode(self.build_title_description(title, description))
+        return self.encode_queries([self.build_title_description(skill_title, skill_description)
+                                    for skill_title, skill_description in skills]) @ vector
+
+    def search_many(self, target_embeddings, top_k):
+        snapshot = self.store.snapshot()
+        return [[(snapshot.title(row), score) for row, score in results]
+                for results in self.index.search_many(target_embeddings, top_k, snapshot)]
+
     # for each skill_type
     def filter_skills(self, title, description, warnings_fn=None):
         try:
-            processed_title = self.preprocess_text(title)
-            processed_description = self.preprocess_text(description)
-            processed_title_description = f"{processed_title or ''}::{processed_description or ''}"
-            target_embedding = self.model.encode(processed_title_description)
-
-            retrieved_skills = {}
-            all_title_similarity_pairs = {}
-
-            # First, load and compute similarities once
-            for path_key, (embeddings_file_path, processed_lines_file_path, title_lines_file_path) in path_data.items():
-                # if path_key not in ['Course', 'Professions']:
-                if all(os.path.exists(file_path) for file_path in
-                       [embeddings_file_path, processed_lines_file_path, title_lines_file_path]):
-                    print(
-                        f"Loading data from {embeddings_file_path}, {processed_lines_file_path}, and {title_lines_file_path}")
-                    skill_embeddings = np.load(embeddings_file_path, allow_pickle=True)
-                    title_lines = np.load(title_lines_file_path, allow_pickle=True).tolist()
-
-                    similarities = util.dot_score(target_embedding, skill_embeddings)[0].cpu().tolist()
-
-                    # Combine docs & scores and sort by decreasing score
-                    title_similarity_pairs = sorted(list(zip(title_lines, similarities)), key=lambda x: x[1],
-                                                    reverse=True)
-                    all_title_similarity_pairs[path_key] = title_similarity_pairs
-                    retrieved_skills[path_key] = title_similarity_pairs
-
-            # Initialize the threshold increment
-            threshold_increment = THRESHOLD_STEP
-
-            # Copy original thresholds to modify
-            current_thresholds = skill_type_threshold.copy()
-
-            while True:
-                total_pairs_count = sum(
-                    len([pair for pair in all_title_similarity_pairs[path_key] if
-                         pair[1] > current_thresholds[path_key]])
-                    for path_key in all_title_similarity_pairs)
-
-                if total_pairs_count <= DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT:
-                    break
-
-                # Increment the thresholds
-                for key in current_thresholds:
-                    current_thresholds[key] += threshold_increment
-
-            # Filter the retrieved_skills with the updated thresholds
-            filtered_titles = []
-            for path_key in retrieved_skills:
-                filtered_titles.extend(
-                    [pair[0] for pair in retrieved_skills[path_key] if pair[1] > current_thresholds[path_key]])
+            self.refresh_active_store()
+            processed_title_description = self.build_title_description(title, description)
+            target_embedding = self.encode_query(processed_title_description)
+
+            if HYBRID_RETRIEVAL:
+                # Fused scores are all positive; the type thresholds were applied to the dense candidates.
+                snapshot = self.store.snapshot()
+                retrieved_skills = self.hybrid_search_by_type(processed_title_description, target_embedding,
+                                                              snapshot)
+                thresholds, budget = {}, HYBRID_MAX_NUMBER_OF_SKILLS_FOR_GPT
+            else:
+                # No type can contribute more than its quota or the overall budget, so the index only has to
+                # return that many candidates per type.
+                retrieved_skills = self.search_by_type(target_embedding, {
+                    path_key: min(DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT,
+                                  skill_type_quota.get(path_key, DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT))
+                    for path_key in path_data})
+                thresholds, budget = skill_type_threshold, DEFAULT_MAX_NUMBER_OF_SKILLS_FOR_GPT
+
+            selected = select_skills(
+                {path_key: np.array([score for _, score in pairs]) for path_key, pairs in retrieved_skills.items()},
+                thresholds, budget, skill_type_quota)
+
+            # Best first across all types, so callers cutting the list to a token budget drop the weakest skills
+            ranked_skills = []
+            for path_key, positions in selected.items():
+                ranked_skills.extend(retrieved_skills[path_key][position] for position in positions)
+            ranked_skills.sort(key=lambda pair: -pair[1])
+            filtered_titles = [title for title, _ in ranked_skills]
+            if HYBRID_RETRIEVAL:
+                filtered_titles = [snapshot.title(row) for row in filtered_titles]
 
             return filtered_titles
 
@@ -203,40 +522,27 @@ class EmbeddingManager:
             return []
 
     def find_top_similar_skills(self, title, description, top_similar, warnings_fn=None):
-        try:
-            processed_title = self.preprocess_text(title)
-            processed_description = self.preprocess_text(description)
-            processed_title_description = f"{processed_title or ''}::{processed_description or ''}"
-            target_embedding = self.model.encode(processed_title_description)
-
-            all_title_similarity_pairs = []
-
-            # Load and compute similarities for all path keys
-            for path_key, (embeddings_file_path, processed_lines_file_path, title_lines_file_path) in path_data.items():
-                if all(os.path.exists(file_path) for file_path in
-                       [embeddings_file_path, processed_lines_file_path, title_lines_file_path]):
-                    print(
-                        f"Loading data from {embeddings_file_path}, {processed_lines_file_path}, and {title_lines_file_path}")
-                    skill_embeddings = np.load(embeddings_file_path, allow_pickle=True)
-                    title_lines = np.load(title_lines_file_path, allow_pickle=True).tolist()
-
-                    similarities = util.dot_score(target_embedding, skill_embeddings)[0].cpu().tolist()
+        return self.find_top_similar_skills_many([(title, description)], top_similar, warnings_fn)[0]
 
-                    # Combine docs & scores and sort by decreasing score
-                    title_similarity_pairs = list(zip(title_lines, similarities))
-                    all_title_similarity_pairs.extend(title_similarity_pairs)
-
-            # Sort all pairs by similarity score in descending order
-            all_title_similarity_pairs.sort(key=lambda x: x[1], reverse=True)
-
-            # Get the top N similar pairs (title, similarity)
-            top_similar_skills = all_title_similarity_pairs[:top_similar]
+    def find_top_similar_skills_many(self, skills, top_similar, warnings_fn=None):
+        # skills: list of (title, description). All of them are encoded in one batch and the store is
+        # scored against all of them at once. Returns the top (title, similarity) pairs for each skill.
+        skills = list(skills)
+        try:
+            self.refresh_active_store()
+            processed_title_descriptions = [self.build_title_description(title, description)
+                                            for title, description in skills]
+            if not processed_title_descriptions:
+                return []
+            target_embeddings = self.encode_queries(processed_title_descriptions)
 
-            return top_similar_skills
+            # Skills of every type are ranked together, so the top N (title, similarity) pairs come straight
+            # from the index
+            return self.search_many(target_embeddings, top_similar)
 
         except Exception as e:
             message = f"Failed to find top similar skills: {e}"
             if warnings_fn:
                 warnings_fn(message)
             print(message)
-            return []
+            return [[] for _ in skills]
@@ -0,0 +1,849 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from managers.string_table import StringTable
+from managers.atomic_file import atomic_write
+from constants import EMBEDDING_STORE_COMPACTION_RATIO, EMBEDDING_STORAGE_MODE, EMBEDDING_STORE_FSYNC, \
+    EMBEDDING_STORE_LOG_RATIO, EMBEDDING_STORE_MIN_LOG_RECORDS
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows) writers are only serialised within one process.
+    fcntl = None
+
+# rows scored at a time, so a compact matrix is never widened to float32 all at once
+SCORE_CHUNK_ROWS = 16384
+
+COMPACT_STORAGE_MODES = ('float16', 'int8')
+
+
+def quantize(vectors, mode):
+    # float16 keeps the vectors as they are; int8 stores every row scaled by max(|row|) / 127.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if mode == 'float16':
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def quantize_chunked(vectors, mode):
+    compact = np.empty(vectors.shape, dtype=np.float16 if mode == 'float16' else np.int8)
+    scales = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SCORE_CHUNK_ROWS):
+        chunk, chunk_scales = quantize(vectors[start:start + SCORE_CHUNK_ROWS], mode)
+        compact[start:start + len(chunk)] = chunk
+        if chunk_scales is not None:
+            scales[start:start + len(chunk)] = chunk_scales
+    return compact, scales if mode == 'int8' else None
+
+
+def chunked_scores(matrix, query, scales=None):
+    # query is one vector or a (dim, queries) matrix; the scores have one row per matrix row either way.
+    scores = np.empty((len(matrix),) + query.shape[1:], dtype=np.float32)
+    for start in range(0, len(matrix), SCORE_CHUNK_ROWS):
+        scores[start:start + SCORE_CHUNK_ROWS] = np.asarray(matrix[start:start + SCORE_CHUNK_ROWS],
+                                                            dtype=np.float32) @ query
+    if scales is not None:
+        scores *= scales.reshape((-1,) + (1,) * (scores.ndim - 1))
+    return scores
+
+
+def append_to_buffer(buffer, count, values):
+    # Writes values after the first count rows of buffer, reallocating it with doubled capacity when full.
+    end = count + len(values)
+    if buffer is None or end > len(buffer):
+        grown = np.empty((max(16, 2 * end),) + values.shape[1:], dtype=values.dtype)
+        if count:
+            grown[:count] = buffer[:count]
+        buffer = grown
+    buffer[count:end] = values
+    return buffer
+
+
+def file_stamp(file_path):
+    # Changes whenever the file is replaced or written to.
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def line_hash(processed_line):
+    return int.from_bytes(hashlib.blake2b(processed_line.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class StoreSnapshot:
+    """The rows of an ``EmbeddingStore`` as of one refresh.
+
+    A snapshot is one generation plus the log records replayed on top of it and is
+    never changed once built: ``EmbeddingStore.refresh`` builds the next one and
+    switches to it with a single assignment. A search that captures a snapshot up
+    front scores, re-ranks and maps rows to titles against the same rows, whatever
+    other threads refresh, write or compact meanwhile.
+
+    Rows replayed from the log are looked up through their own hash index on top of
+    the one of the compacted rows; a deleted row is never found.
+    """
+
+    def __init__(self, version=None, files=None, version_stamp=None, base=None, compact_base=None, base_scales=None,
+                 processed_lines=None, title_lines=None, types=None, rows_by_hash=None):
+        self.version = version
+        self.files = files
+        self.dim = None if base is None else base.shape[1]
+        self.processed_lines = StringTable() if processed_lines is None else processed_lines
+        self.title_lines = StringTable() if title_lines is None else title_lines
+        self.deleted = frozenset()
+        self.retired = False
+        self._version_stamp = version_stamp
+        self._base = base
+        self._compact_base = compact_base
+        self._base_scales = base_scales
+        self._types = np.zeros(0, dtype=np.uint8) if types is None else types
+        self._base_rows_by_hash = {} if rows_by_hash is None else rows_by_hash
+        self._rows_by_hash = {}
+        # The buffer is shared with later snapshots of the generation, which only write past this one's rows.
+        self._appended = None
+        self._appended_count = 0
+        self._log_offset = 0
+        self._log_records = 0
+
+    def _replace(self, **changes):
+        snapshot = copy.copy(self)
+        snapshot.__dict__.update(changes)
+        return snapshot
+
+    @property
+    def base_rows(self):
+        return len(self._base) if self._base is not None else 0
+
+    def __len__(self):
+        return len(self.processed_lines)
+
+    def count(self):
+        return len(self) - len(self.deleted)
+
+    def is_row(self, row):
+        return isinstance(row, int) and 0 <= row < len(self)
+
+    def is_alive(self, row):
+        return 0 <= row < len(self) and row not in self.deleted
+
+    def find(self, processed_line):
+        processed_line_hash = line_hash(processed_line)
+        row = self._rows_by_hash.get(processed_line_hash)
+        if row is None:
+            row = self._base_rows_by_hash.get(processed_line_hash)
+        # Guard against the (unlikely) case of two lines sharing a 64-bit hash.
+        if row is None or row in self.deleted or self.processed_lines[row] != processed_line:
+            return None
+        return row
+
+    def title(self, row):
+        return self.title_lines[row]
+
+    def type(self, row):
+        return int(self._types[row])
+
+    def types(self):
+        # Type code of every row, including tombstoned ones.
+        return self._types
+
+    def entries(self):
+        # (processed line, title, type code) of every live row.
+        for row in np.flatnonzero(self.alive()).tolist():
+            yield self.processed_lines[row], self.title_lines[row], int(self._types[row])
+
+    def rows(self, start, stop):
+        base_rows = self.base_rows
+        parts = []
+        if start < base_rows:
+            parts.append(self._base[start:min(stop, base_rows)])
+        if stop > base_rows:
+            parts.append(self._appended[max(start - base_rows, 0):stop - base_rows])
+        if not parts:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(parts[0]) if len(parts) == 1 else np.concatenate(parts)
+
+    def embeddings(self):
+        # Every row, including tombstoned ones, as a single matrix.
+        return self.rows(0, len(self))
+
+    def alive(self):
+        mask = np.ones(len(self), dtype=bool)
+        if self.deleted:
+            mask[list(self.deleted)] = False
+        return mask
+
+    def scores(self, query, start=0, stop=None):
+        # Scores of rows start to stop. Tombstoned rows score -inf so they never make it into a top-k. In a
+        # quantized store the compacted rows get approximate scores; appended rows are always scored exactly.
+        stop = len(self) if stop is None else stop
+        query = np.asarray(query, dtype=np.float32)
+        base_rows = self.base_rows
+        parts = []
+        if start < base_rows:
+            base_stop = min(stop, base_rows)
+            if self._compact_base is not None:
+                parts.append(chunked_scores(self._compact_base[start:base_stop], query,
+                                            None if self._base_scales is None else self._base_scales[start:base_stop]))
+            else:
+                parts.append(self._base[start:base_stop] @ query)
+        if stop > base_rows:
+            parts.append(self._appended[max(start - base_rows, 0):stop - base_rows] @ query)
+        scores = np.concatenate(parts) if parts else np.empty((0,) + query.shape[1:], dtype=np.float32)
+        deleted = [row - start for row in self.deleted if start <= row < stop]
+        if deleted:
+            scores[deleted] = -np.inf
+        return scores
+
+    def scores_many(self, queries):
+        # All queries are scored with one matrix-matrix product; returns a (queries, rows) matrix.
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+        return np.ascontiguousarray(self.scores(queries.T).T)
+
+    def exact_scores(self, query, rows):
+        rows = np.asarray(rows, dtype=np.intp)
+        base_rows = self.base_rows
+        in_base = rows < base_rows
+
+        vectors = np.empty((len(rows), self.dim or 0), dtype=np.float32)
+        if in_base.any():
+            # Sorted access keeps the reads from the memory map sequential.
+            order = np.argsort(rows[in_base])
+            base_vectors = np.empty((int(in_base.sum()), self.dim), dtype=np.float32)
+            base_vectors[order] = self._base[rows[in_base][order]]
+            vectors[in_base] = base_vectors
+        if (~in_base).any():
+            vectors[~in_base] = self._appended[rows[~in_base] - base_rows]
+
+        scores = vectors @ np.asarray(query, dtype=np.float32)
+        scores[[row in self.deleted for row in rows.tolist()]] = -np.inf
+        return scores
+
+
+class EmbeddingStore:
+    """Append-only, crash-safe embedding store.
+
+    A store is a sequence of generations. Generation 0 is the three ``.npy`` files
+    the store is created with; generation N uses the same names with a ``.vN`` suffix and
+    ``<embeddings>.version`` names the current one. Within a generation the
+    compacted rows are read through a memory map, new rows are appended to a raw
+    float32 file, and every add and delete is journaled as a checksummed record in
+    a write-ahead log that readers replay. Compaction writes the next generation
+    next to the current one and switches to it by atomically replacing the version
+    marker, so a crash at any point leaves one complete generation to load.
+
+    Readers see the store through ``StoreSnapshot``s; ``snapshot`` returns the
+    current one, and a search that reads the store more than once should read it
+    through one snapshot.
+
+    Processed lines and titles of the compacted rows are kept in string tables
+    that are decoded row by row on access. Rows are looked up by processed line
+    through a hash index whose 64-bit line hashes for the compacted rows are
+    persisted next to the ``.npy`` files.
+
+    Every row carries a one-byte type code, saved per generation in ``.types.npy``;
+    ``retype`` changes it with a single log record instead of moving the row.
+
+    Deletes and retypes name the processed line, not the row: a compaction in
+    another instance may renumber the rows at any time, so the row is looked up
+    under the writer lock right before its record is written.
+
+    ``<embeddings>.model.json`` records the model and dimension the vectors were
+    encoded with. A store replaced by one for another model is retired, after
+    which it refuses writes.
+
+    With ``EMBEDDING_STORAGE_MODE`` set to ``float16`` or ``int8`` the compacted
+    rows are scored against a persisted compact copy, and callers re-rank the best
+    candidates with ``exact_scores`` against the full-precision memory map.
+    """
+
+    def __init__(self, embeddings_file_path, processed_lines_file_path, title_lines_file_path,
+                 storage_mode=EMBEDDING_STORAGE_MODE):
+        self.embeddings_file_path = embeddings_file_path
+        self.processed_lines_file_path = processed_lines_file_path
+        self.title_lines_file_path = title_lines_file_path
+        self.paths = (embeddings_file_path, processed_lines_file_path, title_lines_file_path)
+        self.storage_mode = storage_mode
+
+        base_path = os.path.splitext(embeddings_file_path)[0]
+        self.version_file_path = f"{base_path}.version"
+        self.lock_file_path = f"{base_path}.lock"
+        self.compaction_lock_file_path = f"{base_path}.compaction.lock"
+        self.rebuild_lock_file_path = f"{base_path}.rebuild.lock"
+        self.model_file_path = f"{base_path}.model.json"
+
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        # Not loaded yet; the first refresh replaces it.
+        self._snapshot = StoreSnapshot()
+
+    @property
+    def quantized(self):
+        return self.storage_mode != 'float32'
+
+    # The rows as of the last refresh.
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    @property
+    def dim(self):
+        return self._snapshot.dim
+
+    @property
+    def processed_lines(self):
+        return self._snapshot.processed_lines
+
+    @property
+    def title_lines(self):
+        return self._snapshot.title_lines
+
+    @property
+    def deleted(self):
+        return self._snapshot.deleted
+
+    @property
+    def retired(self):
+        return self._snapshot.retired
+
+    @staticmethod
+    def _fsync(file):
+        file.flush()
+        if EMBEDDING_STORE_FSYNC:
+            os.fsync(file.fileno())
+
+    @staticmethod
+    def _save_array(file_path, array):
+        # Also called by readers deriving files for an older generation, so without the writer lock.
+        with atomic_write(file_path) as file:
+            np.save(file, array)
+
+    @staticmethod
+    def _versioned(file_path, version):
+        if not version:
+            return file_path
+        root, extension = os.path.splitext(file_path)
+        return f"{root}.v{version}{extension}"
+
+    def _file_paths(self, version):
+        # Every file that belongs to one generation of the store.
+        embeddings_file_path = self._versioned(self.embeddings_file_path, version)
+        generation_path = os.path.splitext(embeddings_file_path)[0]
+        files = {
+            'embeddings': embeddings_file_path,
+            'processed_lines': self._versioned(self.processed_lines_file_path, version),
+            'title_lines': self._versioned(self.title_lines_file_path, version),
+            'hashes': f"{generation_path}.hashes.npy",
+            'types': f"{generation_path}.types.npy",
+            'scales': f"{generation_path}.scales.npy",
+            'vectors': f"{generation_path}.append",
+            'log': f"{generation_path}.log",
+        }
+        for key in ['processed_lines', 'title_lines']:
+            files[f"{key}_offsets"], files[f"{key}_strings"] = StringTable.file_paths(files[key])
+        for mode in COMPACT_STORAGE_MODES:
+            files[mode] = f"{generation_path}.{mode}.npy"
+        return files
+
+    def _read_version(self):
+        try:
+            with open(self.version_file_path, encoding='utf-8') as version_file:
+                return json.load(version_file)['version']
+        except FileNotFoundError:
+            return 0
+
+    def _write_version(self, version):
+        with atomic_write(self.version_file_path, 'w', encoding='utf-8') as version_file:
+            json.dump({'version': version}, version_file)
+
+    @staticmethod
+    @contextmanager
+    def _file_locked(lock_file_path):
+        os.makedirs(os.path.dirname(lock_file_path) or '.', exist_ok=True)
+        with open(lock_file_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Rebuild locks held by this process; without fcntl they are the only guard.
+    _rebuild_lock_file_paths = set()
+    _rebuild_lock_file_paths_lock = threading.Lock()
+
+    @contextmanager
+    def rebuild_lock(self):
+        # Held for as long as the store is being filled from another one, e.g. by a re-encode. Yields False
+        # without waiting when another instance, in this process or another, already holds it.
+        lock_file_path = os.path.abspath(self.rebuild_lock_file_path)
+        with self._rebuild_lock_file_paths_lock:
+            held = lock_file_path in self._rebuild_lock_file_paths
+            self._rebuild_lock_file_paths.add(lock_file_path)
+        if held:
+            yield False
+            return
+
+        try:
+            os.makedirs(os.path.dirname(lock_file_path), exist_ok=True)
+            with open(lock_file_path, 'a') as lock_file:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        yield False
+                        return
+                # Closing the file releases the lock.
+                yield True
+        finally:
+            with self._rebuild_lock_file_paths_lock:
+                self._rebuild_lock_file_paths.discard(lock_file_path)
+
+    @contextmanager
+    def locked(self):
+        # Serialises writers across threads and, where fcntl is available, across processes. Callers that look
+        # rows up and then write them hold it across both; it may be taken again inside.
+        with self._thread_lock:
+            if self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+
+            with self._file_locked(self.lock_file_path):
+                self._lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth = 0
+
+    def _write_hashes(self, file_path, processed_lines):
+        hashes = np.fromiter((line_hash(line) for line in processed_lines), dtype=np.uint64,
+                             count=len(processed_lines))
+        self._save_array(file_path, hashes)
+        return hashes
+
+    def _is_fresh(self, file_path, base_stamp):
+        # Derived files older than the compacted rows were written for an earlier copy of them.
+        stamp = file_stamp(file_path)
+        return stamp is not None and stamp[0] >= base_stamp[0]
+
+    def _load_hashes(self, files, base_stamp, processed_lines):
+        if self._is_fresh(files['hashes'], base_stamp):
+            hashes = np.load(files['hashes'])
+            if len(hashes) == len(processed_lines):
+                return hashes
+        # Missing or stale, e.g. stores written before the index existed.
+        return self._write_hashes(files['hashes'], processed_lines)
+
+    def _write_compact(self, files, embeddings):
+        compact, scales = quantize_chunked(embeddings, self.storage_mode)
+        self._save_array(files[self.storage_mode], compact)
+        if scales is not None:
+            self._save_array(files['scales'], scales)
+        return compact, scales
+
+    def _load_compact_base(self, files, base_stamp, base):
+        file_paths = [files[self.storage_mode]] + ([files['scales']] if self.storage_mode == 'int8' else [])
+        if all(self._is_fresh(file_path, base_stamp) for file_path in file_paths):
+            compact_base = np.load(files[self.storage_mode], mmap_mode='r')
+            if len(compact_base) == len(base):
+                return compact_base, np.load(files['scales']) if self.storage_mode == 'int8' else None
+
+        return self._write_compact(files, base)
+
+    @staticmethod
+    def _load_lines(files, key):
+        # Lines saved as a pickled object array, as older stores did, are converted to a string
+        # table once and read from the table from then on.
+        file_path = files[key]
+        if os.path.exists(file_path):
+            table_stamp = file_stamp(files[f"{key}_offsets"])
+            if not StringTable.exists(file_path) or table_stamp[0] < file_stamp(file_path)[0]:
+                StringTable.write(file_path, (str(line) for line in np.load(file_path, allow_pickle=True).tolist()))
+        return StringTable.load(file_path)
+
+    def _load_snapshot(self, version, version_stamp):
+        # The compacted rows of one generation, before its log is replayed.
+        files = self._file_paths(version)
+        base_stamp = file_stamp(files['embeddings'])
+        if not os.path.exists(files['embeddings']) or not all(
+                os.path.exists(files[key]) or StringTable.exists(files[key])
+                for key in ['processed_lines', 'title_lines']):
+            return StoreSnapshot(version, files, version_stamp)
+
+        embeddings = np.load(files['embeddings'], mmap_mode='r')
+        if embeddings.ndim == 1:
+            # Stores holding a single skill were saved as a flat vector.
+            embeddings = embeddings.reshape(1, -1)
+
+        processed_lines = self._load_lines(files, 'processed_lines')
+        title_lines = self._load_lines(files, 'title_lines')
+        rows_by_hash = dict(zip(self._load_hashes(files, base_stamp, processed_lines).tolist(),
+                                range(len(processed_lines))))
+        if os.path.exists(files['types']):
+            types = np.array(np.load(files['types']), dtype=np.uint8)
+        else:
+            # Generations written before rows had a type hold a single type.
+            types = np.zeros(len(processed_lines), dtype=np.uint8)
+        compact_base, base_scales = self._load_compact_base(files, base_stamp, embeddings) if self.quantized \
+            else (None, None)
+        return StoreSnapshot(version, files, version_stamp, embeddings, compact_base, base_scales,
+                             processed_lines, title_lines, types, rows_by_hash)
+
+    @staticmethod
+    def _encode_record(record):
+        payload = json.dumps(record).encode('utf-8')
+        return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+    @staticmethod
+    def _decode_record(line):
+        if line.startswith(b'{'):
+            # Written before records carried a checksum.
+            return json.loads(line)
+        checksum, _, payload = line.partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def _replay_log(self, snapshot):
+        # Returns the snapshot with the log records written since it was built applied to a copy of it.
+        log_file_path = snapshot.files['log']
+        with open(log_file_path, 'rb') as log_file:
+            log_file.seek(snapshot._log_offset)
+            data = log_file.read()
+
+        # Only replay complete records; a torn tail is dropped by the next writer.
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return snapshot
+
+        stored_rows = len(snapshot)
+        dim, retired, log_records = snapshot.dim, snapshot.retired, snapshot._log_records
+        lines, titles, types, added = [], [], [], []
+        rows_by_hash = dict(snapshot._rows_by_hash)
+        deleted = set(snapshot.deleted)
+        retyped = {}
+        for line in data[:end].splitlines():
+            log_records += 1
+            record = self._decode_record(line)
+            row = record.get('row') if record else None
+            if record is None:
+                print(f"Skipping corrupt record in {log_file_path}")
+            elif record['op'] in ('delete', 'retype') and not (
+                    isinstance(row, int) and 0 <= row < stored_rows + len(lines)):
+                print(f"Skipping {record['op']} of unknown row {row} in {log_file_path}")
+            elif record['op'] == 'add':
+                dim = record['dim']
+                rows_by_hash[line_hash(record['line'])] = stored_rows + len(lines)
+                lines.append(record['line'])
+                titles.append(record['title'])
+                types.append(record.get('type', 0))
+                added.append(record['offset'] // 4)
+            elif record['op'] == 'delete':
+                deleted.add(row)
+            elif record['op'] == 'retype':
+                retyped[row] = record['type']
+            elif record['op'] == 'retire':
+                retired = True
+
+        all_types = np.concatenate([snapshot._types, np.array(types, dtype=np.uint8)])
+        if retyped:
+            all_types[list(retyped)] = list(retyped.values())
+
+        appended, appended_count = snapshot._appended, snapshot._appended_count
+        if added:
+            flat = np.memmap(snapshot.files['vectors'], dtype=np.float32, mode='r')
+            positions = np.asarray(added)[:, None] + np.arange(dim)
+            appended = append_to_buffer(appended, appended_count, np.asarray(flat[positions], dtype=np.float32))
+            appended_count += len(added)
+
+        return snapshot._replace(
+            dim=dim, retired=retired, deleted=frozenset(deleted),
+            processed_lines=snapshot.processed_lines.extended(lines), title_lines=snapshot.title_lines.extended(titles),
+            _types=all_types, _rows_by_hash=rows_by_hash, _appended=appended, _appended_count=appended_count,
+            _log_offset=snapshot._log_offset + end, _log_records=log_records)
+
+    def refresh(self):
+        # Pick up writes and compactions from other instances since the last call. The new snapshot is built
+        # on the side and switched to with one assignment, so readers holding the old one are unaffected.
+        with self._thread_lock:
+            reload = self._snapshot.version is None
+            for _ in range(3):
+                version_stamp = file_stamp(self.version_file_path)
+                try:
+                    snapshot = self._snapshot
+                    if reload or version_stamp != snapshot._version_stamp:
+                        snapshot = self._load_snapshot(self._read_version(), version_stamp)
+
+                    log_file_path = snapshot.files['log']
+                    if os.path.exists(log_file_path) and os.path.getsize(log_file_path) > snapshot._log_offset:
+                        snapshot = self._replay_log(snapshot)
+                    self._snapshot = snapshot
+                    return
+                except FileNotFoundError:
+                    # A compaction removed this generation while it was being read; load the new one.
+                    reload = True
+            raise RuntimeError(f"Could not load a consistent generation of {self.embeddings_file_path}")
+
+    def snapshot(self):
+        self.refresh()
+        return self._snapshot
+
+    def _append_records(self, records):
+        # Callers hold the lock and have just refreshed, so anything past the replayed offset
+        # is a record torn by a writer that crashed mid-write.
+        snapshot = self._snapshot
+        if snapshot.retired:
+            raise RuntimeError(f"{self.embeddings_file_path} was replaced by a store for another model.")
+        for record in records:
+            if record['op'] in ('delete', 'retype') and not snapshot.is_row(record['row']):
+                raise IndexError(f"Row {record['row']} is not in {self.embeddings_file_path}.")
+        log_file_path = snapshot.files['log']
+        if os.path.exists(log_file_path) and os.path.getsize(log_file_path) > snapshot._log_offset:
+            os.truncate(log_file_path, snapshot._log_offset)
+        with open(log_file_path, 'ab') as log_file:
+            log_file.write(b''.join(self._encode_record(record) for record in records))
+            self._fsync(log_file)
+
+    def exists(self):
+        snapshot = self.snapshot()
+        return snapshot._base is not None or os.path.exists(snapshot.files['log'])
+
+    def model_tag(self):
+        try:
+            with open(self.model_file_path, encoding='utf-8') as model_file:
+                return json.load(model_file)
+        except FileNotFoundError:
+            return None
+
+    def tag(self, model_name, dim):
+        with atomic_write(self.model_file_path, 'w', encoding='utf-8') as model_file:
+            json.dump({'model': model_name, 'dim': dim}, model_file)
+
+    def retire(self):
+        with self.locked():
+            if not self.snapshot().retired:
+                self._append_records([{'op': 'retire'}])
+            self.refresh()
+
+    def entries(self):
+        # (processed line, title, type code) of every live row, all from the snapshot current when iteration
+        # starts, so a compaction running meanwhile cannot shift them.
+        return self.snapshot().entries()
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def count(self):
+        return self.snapshot().count()
+
+    def is_alive(self, row):
+        return self._snapshot.is_alive(row)
+
+    def find(self, processed_line):
+        return self.snapshot().find(processed_line)
+
+    def title(self, row):
+        return self._snapshot.title(row)
+
+    def type(self, row):
+        return self._snapshot.type(row)
+
+    def types(self):
+        return self.snapshot().types()
+
+    @property
+    def generation(self):
+        # Changes whenever a compaction renumbers the rows.
+        return self.snapshot().version
+
+    def rows(self, start, stop):
+        return self.snapshot().rows(start, stop)
+
+    def embeddings(self):
+        return self.snapshot().embeddings()
+
+    def alive(self):
+        return self.snapshot().alive()
+
+    def scores(self, query, start=0, stop=None):
+        # Callers scoring several row ranges take one snapshot and score every range against it instead.
+        return self.snapshot().scores(query, start, stop)
+
+    def scores_many(self, queries):
+        return self.snapshot().scores_many(queries)
+
+    def exact_scores(self, query, rows):
+        return self.snapshot().exact_scores(query, rows)
+
+    def add(self, vector, processed_line, title, type_code=0):
+        return self.add_many([vector], [processed_line], [title], [type_code])[0]
+
+    def add_many(self, vectors, processed_lines, titles, types=None):
+        # One write to the vectors file and one to the log for the whole batch. The vectors are
+        # synced before the log records that point at them.
+        vectors = np.asarray(vectors, dtype='<f4').reshape(len(processed_lines), -1)
+        types = [0] * len(processed_lines) if types is None else types
+        with self.locked():
+            snapshot = self.snapshot()
+            if snapshot.dim is not None and vectors.shape[1] != snapshot.dim:
+                raise ValueError(
+                    f"Vectors of dimension {vectors.shape[1]} do not fit a store of dimension {snapshot.dim}.")
+            os.makedirs(os.path.dirname(snapshot.files['vectors']) or '.', exist_ok=True)
+            with open(snapshot.files['vectors'], 'ab') as vectors_file:
+                offset = vectors_file.tell()
+                vectors_file.write(vectors.tobytes())
+                self._fsync(vectors_file)
+
+            row_size = vectors.shape[1] * vectors.itemsize
+            self._append_records([{'op': 'add', 'dim': vectors.shape[1], 'offset': offset + i * row_size,
+                                   'line': line, 'title': title, 'type': int(type_code)}
+                                  for i, (line, title, type_code) in enumerate(zip(processed_lines, titles, types))])
+            first_row = len(self.snapshot()) - len(processed_lines)
+        self._compact_if_needed_in_background()
+        return list(range(first_row, first_row + len(processed_lines)))
+
+    def delete(self, processed_line):
+        return self.delete_many([processed_line])[0]
+
+    def delete_many(self, processed_lines):
+        # Returns the deleted row of every line, or None for lines that are not in the store.
+        processed_lines = list(processed_lines)
+        if not processed_lines:
+            return []
+        with self.locked():
+            snapshot = self.snapshot()
+            rows = [snapshot.find(line) for line in processed_lines]
+            records = [{'op': 'delete', 'row': row} for row in dict.fromkeys(rows) if row is not None]
+            if records:
+                self._append_records(records)
+                self.refresh()
+        self._compact_if_needed_in_background()
+        return rows
+
+    def retype(self, processed_line, type_code):
+        # Returns the retyped row, or None when the line is not in the store.
+        with self.locked():
+            row = self.snapshot().find(processed_line)
+            if row is not None:
+                self._append_records([{'op': 'retype', 'row': row, 'type': int(type_code)}])
+                self.refresh()
+        self._compact_if_needed_in_background()
+        return row
+
+    def needs_compaction(self):
+        # Tombstones cost space and scoring time. Log records are replayed into memory on every load, and the
+        # rows they append are neither memory-mapped, quantized nor kept in string tables until compacted.
+        snapshot = self.snapshot()
+        return (len(snapshot.deleted) > EMBEDDING_STORE_COMPACTION_RATIO * len(snapshot)
+                or snapshot._log_records > max(EMBEDDING_STORE_MIN_LOG_RECORDS,
+                                               EMBEDDING_STORE_LOG_RATIO * snapshot.base_rows))
+
+    def _compact_if_needed_in_background(self):
+        if self.needs_compaction():
+            self.compact_in_background()
+
+    def compact_in_background(self):
+        with self._thread_lock:
+            if self._compaction_thread is None or not self._compaction_thread.is_alive():
+                self._compaction_thread = threading.Thread(target=self.compact_if_needed, daemon=True)
+                self._compaction_thread.start()
+            return self._compaction_thread
+
+    def compact(self):
+        # Only one compaction may write the next generation's files at a time.
+        with self._compaction_lock, self._file_locked(self.compaction_lock_file_path):
+            self._compact()
+
+    def compact_if_needed(self):
+        # Checked again once the lock is held: a compaction that ran meanwhile may have made this one redundant.
+        with self._compaction_lock, self._file_locked(self.compaction_lock_file_path):
+            if self.needs_compaction():
+                self._compact()
+
+    def _compact(self):
+        # Write the next generation from a snapshot of the current one without blocking writers, then carry
+        # over whatever was logged meanwhile and switch the version marker.
+        with self.locked():
+            snapshot = self.snapshot()
+        version, old_files = snapshot.version, snapshot.files
+        snapshot_rows = len(snapshot)
+        types = snapshot.types()
+
+        alive = snapshot.alive()
+        live_rows = int(alive.sum())
+        new_rows = np.full(snapshot_rows, -1)
+        new_rows[alive] = np.arange(live_rows)
+
+        new_version = version + 1
+        new_files = self._file_paths(new_version)
+        for key in ['vectors', 'log']:
+            # Left behind by a compaction that crashed before switching the version marker.
+            if os.path.exists(new_files[key]):
+                os.remove(new_files[key])
+
+        embeddings = np.asarray(snapshot.embeddings()[alive], dtype=np.float32)
+        processed_lines = [line for line, keep in zip(snapshot.processed_lines, alive) if keep]
+        self._save_array(new_files['embeddings'], embeddings)
+        StringTable.write(new_files['processed_lines'], processed_lines)
+        StringTable.write(new_files['title_lines'], (title for title, keep in zip(snapshot.title_lines, alive) if keep))
+        self._write_hashes(new_files['hashes'], processed_lines)
+        self._save_array(new_files['types'], types[alive])
+        if self.quantized:
+            self._write_compact(new_files, embeddings)
+
+        with self.locked():
+            current = self.snapshot()
+            if current.version != version:
+                # Another instance compacted first; its generation already has everything.
+                return
+
+            records = []
+            total_rows = len(current)
+            if total_rows > snapshot_rows:
+                with open(new_files['vectors'], 'wb') as vectors_file:
+                    vectors_file.write(np.asarray(current.rows(snapshot_rows, total_rows), dtype='<f4').tobytes())
+                    self._fsync(vectors_file)
+                records.extend({'op': 'add', 'dim': current.dim, 'offset': i * current.dim * 4, 'line': line,
+                                'title': title, 'type': int(type_code)}
+                               for i, (line, title, type_code) in enumerate(zip(
+                                   current.processed_lines[snapshot_rows:], current.title_lines[snapshot_rows:],
+                                   current.types()[snapshot_rows:])))
+            for row in np.flatnonzero(current.types()[:snapshot_rows] != types):
+                if new_rows[row] >= 0:
+                    records.append({'op': 'retype', 'row': int(new_rows[row]), 'type': int(current.type(row))})
+            if current.retired:
+                records.append({'op': 'retire'})
+            for row in sorted(current.deleted - snapshot.deleted):
+                new_row = new_rows[row] if row < snapshot_rows else live_rows + row - snapshot_rows
+                if new_row >= 0:
+                    records.append({'op': 'delete', 'row': int(new_row)})
+            if records:
+                with open(new_files['log'], 'wb') as log_file:
+                    log_file.write(b''.join(self._encode_record(record) for record in records))
+                    self._fsync(log_file)
+
+            self._write_version(new_version)
+            self.refresh()
+
+        for file_path in old_files.values():
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -0,0 +1,106 @@
+import math
+import os
+import threading
+from collections import Counter
+import numpy as np
+from managers.skill_selection import top_k_indices
+from constants import BM25_K1, BM25_B
+
+
+class BM25Index:
+    """BM25 inverted index over the processed lines of an ``EmbeddingStore``.
+
+    The index is built in memory from the store's own string table, so it covers
+    exactly the rows the dense index does. Rows appended to the store are indexed
+    on the next search, tombstoned rows never score, and the index is rebuilt when
+    a compaction renumbers the rows.
+
+    A search scores the rows of one ``StoreSnapshot``, leaving out rows that a
+    later snapshot added to the index. Searches from several threads take turns,
+    since indexing new rows changes the postings being read.
+    """
+
+    def __init__(self, store, k1=BM25_K1, b=BM25_B):
+        self.store = store
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._generation = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}
+        self._document_lengths = []
+
+    @staticmethod
+    def tokenize(processed_line):
+        # Processed lines are already lower-cased with punctuation and stop words removed.
+        return processed_line.replace('::', ' ').split()
+
+    def _sync(self, snapshot):
+        # Callers hold the lock.
+        if snapshot.version != self._generation:
+            self._reset()
+            self._generation = snapshot.version
+
+        for row in range(len(self._document_lengths), len(snapshot)):
+            terms = self.tokenize(snapshot.processed_lines[row])
+            for term, frequency in Counter(terms).items():
+                rows, frequencies = self._postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+            self._document_lengths.append(len(terms))
+
+    def scores(self, processed_query, snapshot=None):
+        # BM25 score of every row of the snapshot; rows sharing no term with the query score 0.
+        snapshot = self.store.snapshot() if snapshot is None else snapshot
+        total_rows = len(snapshot)
+        scores = np.zeros(total_rows, dtype=np.float32)
+        if not total_rows:
+            return scores
+
+        with self._lock:
+            self._sync(snapshot)
+            document_lengths = np.asarray(self._document_lengths[:total_rows], dtype=np.float32)
+            average_length = float(document_lengths.sum()) / total_rows or 1.0
+            for term in set(self.tokenize(processed_query)):
+                if term not in self._postings:
+                    continue
+                rows, frequencies = (np.asarray(values) for values in self._postings[term])
+                in_snapshot = rows < total_rows
+                rows, frequencies = rows[in_snapshot], frequencies[in_snapshot]
+                if not len(rows):
+                    continue
+                idf = math.log(1 + (total_rows - len(rows) + 0.5) / (len(rows) + 0.5))
+                norms = self.k1 * (1 - self.b + self.b * document_lengths[rows] / average_length)
+                scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norms)
+
+        if snapshot.deleted:
+            scores[list(snapshot.deleted)] = 0
+        return scores
+
+    def search_by_type(self, processed_query, top_k_by_type, snapshot=None):
+        # ``(row, score)`` pairs of the best matching rows of every type, leaving out rows without a match.
+        snapshot = self.store.snapshot() if snapshot is None else snapshot
+        scores = self.scores(processed_query, snapshot)
+        types = snapshot.types()
+        results = {}
+        for type_code, top_k in top_k_by_type.items():
+            type_scores = np.where(types == type_code, scores, 0)
+            results[type_code] = [(int(row), float(type_scores[row])) for row in top_k_indices(type_scores, top_k)
+                                  if type_scores[row] > 0]
+        return results
+
+
+_bm25_indexes = {}
+_bm25_indexes_lock = threading.Lock()
+
+
+def bm25_index(store):
+    # One index per store for the whole process: Streamlit builds new managers on every rerun, and each of them
+    # would otherwise decode and tokenise every processed line again on its first search.
+    key = os.path.abspath(store.embeddings_file_path)
+    with _bm25_indexes_lock:
+        if key not in _bm25_indexes:
+            _bm25_indexes[key] = BM25Index(store)
+        return _bm25_indexes[key]
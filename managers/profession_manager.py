@@ -1,5 +1,8 @@
+import asyncio
 import pandas as pd
 from py2neo import Node, Relationship, NodeMatcher
+from services.GPTClient import AsyncGPTClient
+from managers.thread_warnings import to_thread_with_warnings
 from constants import *
 
 
@@ -11,16 +14,15 @@ from constants import *
 # Description / description_en
 
 class ProfessionManager:
-    def __init__(self, graph, gpt_client, embedding_manager, skill_manager):
+    def __init__(self, graph, gpt_client, embedding_manager, skill_manager, skill_matcher):
         self.graph = graph
         self.gpt_client = gpt_client
         self.embedding_manager = embedding_manager
         self.skill_manager = skill_manager
+        self.skill_matcher = skill_matcher
         self.matcher = NodeMatcher(graph)
 
-    def add_profession(self, title, title_fi, description=" ", skills=" ", description_fi=" ", source_sl=" ",
-                       source_id=" ", warnings_fn=None):
-
+    def profession_exists(self, title, source_id, warnings_fn=None):
         existing_profession = self.matcher.match(DEFAULT_PROFESSION_LABEL,
                                                  source_Id=source_id).first()
 
@@ -29,12 +31,62 @@ class ProfessionManager:
             print(message)
             if warnings_fn:
                 warnings_fn(message)
+            return True
+        return False
+
+    def add_profession(self, title, title_fi, description=" ", skills=" ", description_fi=" ", source_sl=" ",
+                       source_id=" ", warnings_fn=None):
+
+        if self.profession_exists(title, source_id, warnings_fn):
             return
 
         # maybe to use in production
         # skills = self.gpt_client.extract_skills_from_profession_description(title_description_en)
         skills = description
 
+        # self.embedding_manager.add_to_embeddings(title, skills, 'Professions', warnings_fn=warnings_fn)
+
+        filtered_skills = self.embedding_manager.filter_skills(title=title, description=skills,
+                                                               warnings_fn=warnings_fn)
+
+        matched_skills = self.skill_matcher.match_skills_for_profession(filtered_skills, f"{title}::{skills}",
+                                                                        warnings_fn=warnings_fn)
+        if matched_skills is None:
+            self.report_unmatched_profession(title, warnings_fn)
+            return
+
+        self.create_profession(title, title_fi, description, skills, description_fi, source_sl, source_id,
+                               matched_skills, warnings_fn)
+
+    async def prepare_profession_async(self, async_gpt_client, title, title_fi, description=" ", description_fi=" ",
+                                       source_sl=" ", source_id=" ", warnings_fn=None):
+        # Everything add_profession does before it writes to the graph, with the GPT call awaited so that other
+        # professions proceed meanwhile. Returns the arguments of create_profession, or None for existing ones and
+        # for ones whose skills could not be matched.
+        if await to_thread_with_warnings(self.profession_exists, title, source_id, warnings_fn=warnings_fn):
+            return None
+
+        skills = description
+        filtered_skills = await to_thread_with_warnings(self.embedding_manager.filter_skills, title=title,
+                                                        description=skills, warnings_fn=warnings_fn)
+        matched_skills = await self.skill_matcher.match_skills_for_profession_async(
+            filtered_skills, f"{title}::{skills}", async_gpt_client, warnings_fn=warnings_fn)
+        if matched_skills is None:
+            self.report_unmatched_profession(title, warnings_fn)
+            return None
+
+        return title, title_fi, description, skills, description_fi, source_sl, source_id, matched_skills
+
+    @staticmethod
+    def report_unmatched_profession(title, warnings_fn=None):
+        # The profession is not created, so the next import of the file tries it again
+        message = f"Skills of profession {title} could not be matched; the profession was not added."
+        print(message)
+        if warnings_fn:
+            warnings_fn(message)
+
+    def create_profession(self, title, title_fi, description, skills, description_fi, source_sl, source_id,
+                          matched_skills, warnings_fn=None):
         profession_node = Node(DEFAULT_PROFESSION_LABEL,
                                source_Sl=source_sl,
                                source_Id=source_id,
@@ -46,19 +98,16 @@ class ProfessionManager:
                                )
         self.graph.create(profession_node)
 
-        # self.embedding_manager.add_to_embeddings(title, skills, 'Professions', warnings_fn=warnings_fn)
-
-        filtered_skills = self.embedding_manager.filter_skills(title=title, description=skills,
-                                                               warnings_fn=warnings_fn)
-
-        matched_skills = self.gpt_client.match_skills_for_profession(filtered_skills, f"{title}::{skills}")
+        # Skills without a matching candidate are resolved against the embeddings in one batch
+        resolved_new_skills = iter(self.skill_manager.handle_new_skills(
+            [pair['extracted_skill'] for pair in matched_skills if pair['common_skill'].lower() == 'new']))
 
         for pair in matched_skills:
             extracted_skill = pair['extracted_skill']
             matched_skill = pair['common_skill']
 
             if matched_skill.lower() == 'new':
-                matched_skill, relationship_type = self.skill_manager.handle_new_skill(extracted_skill)
+                matched_skill, relationship_type = next(resolved_new_skills)
             else:
                 relationship_type = f"EXACT [{extracted_skill}]"
 
@@ -79,6 +128,10 @@ class ProfessionManager:
                     warnings_fn(message)
 
     def add_professions_batch(self, professions_batch, warnings_fn=None):
+        if ASYNC_INGESTION:
+            asyncio.run(self.add_professions_batch_async(professions_batch, warnings_fn))
+            return
+
         for profession_data in professions_batch:
             self.add_profession(
                 source_sl=profession_data['source_sl'],
@@ -89,6 +142,31 @@ class ProfessionManager:
                 warnings_fn=warnings_fn
             )
 
+    async def add_professions_batch_async(self, professions_batch, warnings_fn=None):
+        # The professions of the batch are prepared concurrently and written to the graph in batch order
+        async with AsyncGPTClient(self.gpt_client) as async_gpt_client:
+            prepared_professions = await asyncio.gather(*(
+                self.prepare_profession_async(
+                    async_gpt_client,
+                    source_sl=profession_data['source_sl'],
+                    source_id=profession_data['source_id'],
+                    title=profession_data['title'],
+                    title_fi=profession_data['title_fi'],
+                    description=profession_data['description'],
+                    warnings_fn=warnings_fn
+                ) for profession_data in professions_batch), return_exceptions=True)
+
+        for profession_data, prepared_profession in zip(professions_batch, prepared_professions):
+            if isinstance(prepared_profession, Exception):
+                message = f"Failed to add profession {profession_data['title']}: {prepared_profession}"
+                print(message)
+                if warnings_fn:
+                    warnings_fn(message)
+            # The same profession may appear twice in one batch
+            elif prepared_profession is not None and not self.profession_exists(
+                    profession_data['title'], profession_data['source_id'], warnings_fn):
+                self.create_profession(*prepared_profession, warnings_fn=warnings_fn)
+
     def load_professions_from_file(self, file_path, batch_size=BATCH_SIZE, warnings_fn=None, progress_fn=None):
 
         try:
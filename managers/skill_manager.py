@@ -1,5 +1,5 @@
 import pandas as pd
-from py2neo import Node, NodeMatcher
+from py2neo import Node, NodeMatcher, Subgraph
 from constants import *
 
 
@@ -103,6 +103,7 @@ class SkillManager:
             # Process any remaining skills in the last batch
             if skills_batch:
                 self.add_skills_batch(skills_batch, warnings_fn)
+            self.embedding_manager.compact_store()
 
             print("All skills loaded from file and added successfully.")
             return True
@@ -115,18 +116,46 @@ class SkillManager:
 
     def add_skills_batch(self, skills_batch, warnings_fn=None):
         try:
+            # Look up which titles already exist with one query per label instead of one per skill
+            existing_titles = {}
+            new_skills = []
             for skill in skills_batch:
-                self.add_skill(
-                    skill_source_id=skill['skill_source_id'],
-                    skill_source_code=skill['skill_source_code'],
-                    skill_title=skill['skill_title'],
-                    skill_title_fi=skill['skill_title_fi'],
-                    skill_description=skill['skill_description'],
-                    skill_description_fi=skill['skill_description_fi'],
-                    skill_label=skill['skill_label'],
-                    skill_type=skill['skill_type'],
-                    warnings_fn=warnings_fn
-                )
+                skill_label = skill['skill_label']
+                if skill_label not in existing_titles:
+                    titles = [s['skill_title'] for s in skills_batch if s['skill_label'] == skill_label]
+                    existing_titles[skill_label] = {record['title'] for record in self.graph.run(
+                        f"UNWIND $titles AS title MATCH (s:{skill_label} {{title: title}}) RETURN s.title AS title",
+                        titles=titles
+                    ).data()}
+
+                if skill['skill_title'] in existing_titles[skill_label]:
+                    message = f"Skill '{skill['skill_title']}' already exists in the graph."
+                    print(message)
+                    if warnings_fn:
+                        warnings_fn(message)
+                    continue
+
+                existing_titles[skill_label].add(skill['skill_title'])
+                new_skills.append(skill)
+
+            # Encode the whole batch with one model call and one write per embedding store
+            self.embedding_manager.add_to_embeddings_batch(
+                [(skill['skill_title'], skill['skill_description'], skill['skill_type']) for skill in new_skills],
+                warnings_fn
+            )
+
+            skill_nodes = [Node(skill['skill_label'],
+                                title=skill['skill_title'],
+                                description=skill['skill_description'],
+                                type=skill['skill_type'],
+                                source_id=skill['skill_source_id'],
+                                source_code=skill['skill_source_code'],
+                                title_fi=skill['skill_title_fi'],
+                                description_fi=skill['skill_description_fi'])
+                           for skill in new_skills]
+            if skill_nodes:
+                self.graph.create(Subgraph(skill_nodes))
+            return True
         except Exception as e:
             message = f"An error occurred while adding skills batch: {e}"
             print(message)
@@ -158,6 +187,40 @@ class SkillManager:
         self.embedding_manager.delete_from_embeddings(title, description, type, warnings_fn)
         return True
 
+    def reconcile_embeddings(self, warnings_fn=None):
+        # Streams every skill node from the graph and brings the embeddings in line with it
+        cursor = self.graph.run(
+            f"MATCH (s) WHERE s:{DEFAULT_SKILL_LABEL} OR s:{DEFAULT_NEW_SKILL_LABEL} "
+            "RETURN s.title AS title, s.description AS description, s.type AS type")
+        skills = ((record['title'], record['description'], record['type']) for record in cursor if record['title'])
+        report = self.embedding_manager.reconcile_embeddings(skills, warnings_fn)
+
+        message = (f"Embeddings reconciled: {len(report['added'])} added, {len(report['retyped'])} retyped, "
+                   f"{len(report['deleted'])} deleted, {report['unchanged']} unchanged, "
+                   f"{len(report['skipped'])} skipped.")
+        print(message)
+        if warnings_fn:
+            warnings_fn(message)
+        return report
+
+    def translate_new_skill_titles(self, warnings_fn=None):
+        # New skills are created without a Finnish title; translates all of them in batches of requests
+        titles = [record['title'] for record in self.graph.run(
+            f"MATCH (s:{DEFAULT_NEW_SKILL_LABEL}) WHERE s.title_fi IS NULL OR s.title_fi = 'none' "
+            "RETURN s.title AS title") if record['title']]
+        translations = self.gpt_client.translate_many(titles, target_language="Finnish", warnings_fn=warnings_fn)
+        translated = [{'title': title, 'title_fi': title_fi} for title, title_fi in zip(titles, translations)
+                      if title_fi]
+        self.graph.run(
+            f"UNWIND $skills AS skill MATCH (s:{DEFAULT_NEW_SKILL_LABEL} {{title: skill.title}}) "
+            "SET s.title_fi = skill.title_fi", skills=translated)
+
+        message = f"Finnish titles added to {len(translated)} of {len(titles)} new skills."
+        print(message)
+        if warnings_fn:
+            warnings_fn(message)
+        return len(translated)
+
     def update_skill(self, old_skill_title, warnings_fn=None, **kwargs):
         # Attempt to find the existing skill in the graph
         existing_skill = self.matcher.match(DEFAULT_SKILL_LABEL, title=old_skill_title).first()
@@ -221,26 +284,45 @@ class SkillManager:
         return True
 
     def handle_new_skill(self, extracted_skill, warnings_fn=None):
-        similar_skills = self.embedding_manager.find_top_similar_skills(extracted_skill, " ", top_similar=1)
-        if similar_skills and similar_skills[0][1] > DEFAULT_THRESHOLD_FOR_CREATING_NEW_SKILLS:
-            matched_skill_title, similarity_score = similar_skills[0]
-            relationship_type = f"SM [{extracted_skill}] {similarity_score:.2f}"
-        else:
-            self.add_skill(
-                skill_source_id="none",
-                skill_source_code="none",
-                skill_title=extracted_skill,
-                skill_title_fi="none",
-                skill_description="none",
-                skill_description_fi="none",
-                skill_label=DEFAULT_NEW_SKILL_LABEL,
-                skill_type=DEFAULT_SKILL_TYPE_PROFESSIONAL,
-                warnings_fn=warnings_fn
-            )
-            matched_skill_title = extracted_skill
-            relationship_type = "NEW"
-
-        return matched_skill_title, relationship_type
+        return self.handle_new_skills([extracted_skill], warnings_fn)[0]
+
+    def handle_new_skills(self, extracted_skills, warnings_fn=None):
+        # Searches the store for all skills at once. A skill created along the way can be the best match for
+        # the ones after it, as resolving them one by one would find, so only they are scored against it.
+        extracted_skills = list(extracted_skills)
+        queries = [(skill, " ") for skill in extracted_skills]
+        best_matches = [similar_skills[0] if similar_skills else None for similar_skills in
+                        self.embedding_manager.find_top_similar_skills_many(queries, top_similar=1)]
+        results = []
+        for position, extracted_skill in enumerate(extracted_skills):
+            best_match = best_matches[position]
+            if best_match and best_match[1] > DEFAULT_THRESHOLD_FOR_CREATING_NEW_SKILLS:
+                matched_skill_title, similarity_score = best_match
+                relationship_type = f"SM [{extracted_skill}] {similarity_score:.2f}"
+            else:
+                self.add_skill(
+                    skill_source_id="none",
+                    skill_source_code="none",
+                    skill_title=extracted_skill,
+                    skill_title_fi="none",
+                    skill_description="none",
+                    skill_description_fi="none",
+                    skill_label=DEFAULT_NEW_SKILL_LABEL,
+                    skill_type=DEFAULT_SKILL_TYPE_PROFESSIONAL,
+                    warnings_fn=warnings_fn
+                )
+                matched_skill_title = extracted_skill
+                relationship_type = "NEW"
+                later = range(position + 1, len(extracted_skills))
+                if later:
+                    scores = self.embedding_manager.similarities(extracted_skill, "none", queries[position + 1:])
+                    for later_position, score in zip(later, scores.tolist()):
+                        if best_matches[later_position] is None or score > best_matches[later_position][1]:
+                            best_matches[later_position] = (extracted_skill, score)
+
+            results.append((matched_skill_title, relationship_type))
+
+        return results
 
     def get_all_skills(self):
         skills_original = self.matcher.match(DEFAULT_SKILL_LABEL).all()
@@ -0,0 +1,142 @@
+import asyncio
+import re
+import threading
+import numpy as np
+from sentence_transformers import CrossEncoder
+from constants import CROSS_ENCODER_MODEL_NAME, CROSS_ENCODER_ACCEPT_SCORE, CROSS_ENCODER_ACCEPT_MARGIN, \
+    CROSS_ENCODER_REJECT_SCORE, CROSS_ENCODER_CANDIDATES_FOR_GPT, LOCAL_SKILL_MATCHING
+
+# "1. **Skill**: description", "- Skill - description", "• Skill"; groups: indentation, number, text
+LIST_ITEM = re.compile(r'^(\s*)(?:(\d+[.)])|[-*•])\s+(.+)$')
+TITLE_SEPARATOR = re.compile(r'\s*(?::|\s-\s|\s–\s)\s*')
+
+
+def split_extracted_skills(skills_text):
+    # (title, description) of every top-level list item in an extracted skills text; prose without a list yields
+    # nothing. In a numbered list only the numbered items are skills, otherwise the least indented bullets are.
+    # Items nested under a skill, e.g. "   - Description: ...", are added to its description.
+    items = [(len(item.group(1).expandtabs()), item.group(2) is not None, item.group(3).replace('**', '').strip())
+             for item in map(LIST_ITEM.match, skills_text.splitlines()) if item]
+    numbered = any(is_numbered for _, is_numbered, _ in items)
+    top_indent = min((indent for indent, is_numbered, _ in items if is_numbered == numbered), default=0)
+
+    extracted_skills = []
+    for indent, is_numbered, text in items:
+        if is_numbered == numbered and indent <= top_indent:
+            title, description = (TITLE_SEPARATOR.split(text, maxsplit=1) + [''])[:2]
+            if title.strip():
+                extracted_skills.append((title.strip(), description.strip()))
+        elif extracted_skills:
+            title, description = extracted_skills[-1]
+            extracted_skills[-1] = (title, f"{description}; {text}" if description else text)
+    return extracted_skills
+
+
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+
+def cross_encoder(model_name):
+    # Loaded on first use and shared by the whole process: main.py builds a DatabaseManager on every Streamlit
+    # rerun, and most reruns never match skills.
+    with _cross_encoders_lock:
+        if model_name not in _cross_encoders:
+            _cross_encoders[model_name] = CrossEncoder(model_name)
+        return _cross_encoders[model_name]
+
+
+class SkillMatcher:
+    """Matches extracted skills to the candidates of ``filter_skills`` before asking GPT.
+
+    A cross-encoder scores every extracted skill against every candidate title in
+    one batch on the CPU. A skill whose best candidate is clearly ahead is paired
+    with it, a skill no candidate comes close to is paired with 'new', and only the
+    ambiguous rest is sent to GPT together with its best candidates. The pairs
+    have the same ``extracted_skill``/``common_skill`` format as GPT's.
+    """
+
+    def __init__(self, gpt_client, model_name=CROSS_ENCODER_MODEL_NAME):
+        self.gpt_client = gpt_client
+        self.model_name = model_name if LOCAL_SKILL_MATCHING else None
+
+    @property
+    def model(self):
+        return None if self.model_name is None else cross_encoder(self.model_name)
+
+    def match_skills_for_course(self, filtered_skills, combined_description, warnings_fn=None):
+        return self.match_skills(filtered_skills, combined_description, self.gpt_client.match_skills_for_course,
+                                 warnings_fn)
+
+    def match_skills_for_profession(self, filtered_skills, profession_description, warnings_fn=None):
+        return self.match_skills(filtered_skills, profession_description,
+                                 self.gpt_client.match_skills_for_profession, warnings_fn)
+
+    async def match_skills_for_course_async(self, filtered_skills, combined_description, async_gpt_client,
+                                            warnings_fn=None):
+        return await self.match_skills_async(filtered_skills, combined_description,
+                                             async_gpt_client.match_skills_for_course, warnings_fn)
+
+    async def match_skills_for_profession_async(self, filtered_skills, profession_description, async_gpt_client,
+                                                warnings_fn=None):
+        return await self.match_skills_async(filtered_skills, profession_description,
+                                             async_gpt_client.match_skills_for_profession, warnings_fn)
+
+    def match_skills(self, filtered_skills, combined_description, gpt_match, warnings_fn=None):
+        # None when GPT failed to match the skills left to it; callers skip the row rather than create it
+        # without them
+        matched_skills, gpt_request = self.rerank(filtered_skills, combined_description)
+        if gpt_request:
+            gpt_matches = gpt_match(*gpt_request, warnings_fn=warnings_fn)
+            if gpt_matches is None:
+                return None
+            matched_skills.extend(gpt_matches)
+        return matched_skills
+
+    async def match_skills_async(self, filtered_skills, combined_description, gpt_match, warnings_fn=None):
+        # The cross-encoder runs in a worker thread, so the event loop keeps serving other rows meanwhile
+        matched_skills, gpt_request = await asyncio.to_thread(self.rerank, filtered_skills, combined_description)
+        if gpt_request:
+            gpt_matches = await gpt_match(*gpt_request, warnings_fn=warnings_fn)
+            if gpt_matches is None:
+                return None
+            matched_skills.extend(gpt_matches)
+        return matched_skills
+
+    def rerank(self, filtered_skills, combined_description):
+        # The pairs settled locally and the (candidates, description) left for GPT to match, or None.
+        # combined_description: "title::skills"; skills that are not a list go to GPT as before
+        title, _, skills_text = combined_description.partition('::')
+        extracted_skills = split_extracted_skills(skills_text)
+        if self.model_name is None or not extracted_skills or not filtered_skills:
+            return [], (filtered_skills, combined_description)
+
+        skill_texts = [f"{skill_title}: {description}" if description else skill_title
+                       for skill_title, description in extracted_skills]
+        scores = np.asarray(self.model.predict([(skill_text, candidate) for skill_text in skill_texts
+                                                for candidate in filtered_skills]),
+                            dtype=np.float32).reshape(len(skill_texts), len(filtered_skills))
+
+        matched_skills = []
+        ambiguous = []
+        for (skill_title, _), skill_text, skill_scores in zip(extracted_skills, skill_texts, scores):
+            ranking = np.argsort(-skill_scores, kind='stable')
+            best_score = skill_scores[ranking[0]]
+            runner_up_score = skill_scores[ranking[1]] if len(ranking) > 1 else -np.inf
+            if best_score >= CROSS_ENCODER_ACCEPT_SCORE and best_score - runner_up_score >= CROSS_ENCODER_ACCEPT_MARGIN:
+                matched_skills.append({"extracted_skill": skill_title, "common_skill": filtered_skills[ranking[0]]})
+            elif best_score < CROSS_ENCODER_REJECT_SCORE:
+                matched_skills.append({"extracted_skill": skill_title, "common_skill": "new"})
+            else:
+                ambiguous.append((skill_text, ranking[:CROSS_ENCODER_CANDIDATES_FOR_GPT]))
+
+        print(f"Cross-encoder matched {len(matched_skills)} of {len(extracted_skills)} skills; "
+              f"{len(ambiguous)} left for GPT.")
+        if not ambiguous:
+            return matched_skills, None
+
+        # GPT only sees the ambiguous skills and their best candidates, in the order filter_skills ranked them
+        candidates = sorted({int(position) for _, ranking in ambiguous for position in ranking})
+        ambiguous_description = "\n".join(f"{number}. {skill_text}"
+                                          for number, (skill_text, _) in enumerate(ambiguous, start=1))
+        return matched_skills, ([filtered_skills[position] for position in candidates],
+                                f"{title}::{ambiguous_description}")
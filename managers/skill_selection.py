@@ -0,0 +1,66 @@
+import numpy as np
+from constants import RRF_K
+
+
+def top_k_indices(values, k):
+    # Indices of the k largest values in O(n), ordered by decreasing value. Ties at the
+    # cut-off and in the ordering go to the lower index so the result is deterministic.
+    values = np.asarray(values)
+    if k <= 0 or not len(values):
+        return np.empty(0, dtype=np.intp)
+
+    if k >= len(values):
+        indices = np.arange(len(values))
+    else:
+        kth_value = np.partition(values, len(values) - k)[len(values) - k]
+        above = np.flatnonzero(values > kth_value)
+        ties = np.flatnonzero(values == kth_value)[:k - len(above)]
+        indices = np.concatenate([above, ties])
+
+    return indices[np.lexsort((indices, -values[indices]))]
+
+
+def select_skills(scores_by_type, thresholds, budget, quotas=None):
+    """Picks at most ``budget`` candidates across skill types in a single pass.
+
+    Candidates are ranked by how far their score clears the threshold of their type,
+    which is the order in which raising every threshold in lock-step would drop
+    them. Scores at or below the threshold never qualify and ``quotas`` caps how
+    many candidates one type may contribute. Returns, per type, the positions of the
+    selected scores ordered by decreasing score.
+    """
+    quotas = quotas or {}
+    scores_by_type = {skill_type: np.asarray(scores, dtype=np.float64) for skill_type, scores in scores_by_type.items()}
+    margins = []
+    positions = []
+    for skill_type, scores in scores_by_type.items():
+        threshold = thresholds.get(skill_type, 0.0)
+        qualified = np.flatnonzero(scores > threshold)
+        type_margins = scores[qualified] - threshold
+
+        quota = quotas.get(skill_type)
+        if quota is not None and len(qualified) > quota:
+            keep = np.sort(top_k_indices(type_margins, quota))
+            qualified, type_margins = qualified[keep], type_margins[keep]
+
+        margins.append(type_margins)
+        positions.append(qualified)
+
+    offsets = np.cumsum([0] + [len(type_positions) for type_positions in positions])
+    selected = np.sort(top_k_indices(np.concatenate(margins) if margins else [], budget))
+
+    selected_by_type = {}
+    for (skill_type, scores), type_positions, start, end in zip(scores_by_type.items(), positions, offsets[:-1],
+                                                                  offsets[1:]):
+        chosen = type_positions[selected[(selected >= start) & (selected < end)] - start]
+        selected_by_type[skill_type] = chosen[np.lexsort((chosen, -scores[chosen]))]
+    return selected_by_type
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # Scores every item by the sum of 1 / (k + rank) over the rankings it appears in, ranks starting at 1.
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank)
+    return fused
@@ -375,8 +375,9 @@ class StreamlitSkillManager:
                     st.session_state[f'button_desc_fi_{selected_skill["title"]}_pressed'] = True
 
             if st.session_state[f'button_desc_en_{selected_skill["title"]}_pressed']:
+                # The button asks for a new description, not the one generated last time
                 description_en_value = self.skill_manager.gpt_client.generate_skill_description_english(
-                    selected_skill['title'], get_gpt_description(selected_skill['title']))
+                    selected_skill['title'], get_gpt_description(selected_skill['title']), use_cache=False)
                 st.session_state[key_en] = description_en_value
 
                 st.session_state[f'button_desc_en_{selected_skill["title"]}_pressed'] = False
@@ -384,7 +385,7 @@ class StreamlitSkillManager:
 
             if st.session_state[f'button_desc_fi_{selected_skill["title"]}_pressed']:
                 description_fi_value = self.skill_manager.gpt_client.generate_skill_description_finnish(
-                    selected_skill['title'], get_gpt_description(selected_skill['title']))
+                    selected_skill['title'], get_gpt_description(selected_skill['title']), use_cache=False)
                 st.session_state[key_fi] = description_fi_value
                 st.session_state[f'button_desc_fi_{selected_skill["title"]}_pressed'] = False
                 st.rerun()
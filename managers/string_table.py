@@ -0,0 +1,71 @@
+import os
+import numpy as np
+from managers.atomic_file import atomic_write
+
+
+class StringTable:
+    """Strings stored as one UTF-8 blob plus the offset at which every string starts.
+
+    Both files are memory-mapped and a string is only decoded when its row is read,
+    so loading a table costs nothing per row. A table is never changed once built:
+    ``extended`` returns a copy with more strings, which are kept in memory, and
+    ``write`` persists a table.
+    """
+
+    def __init__(self, offsets=None, blob=b''):
+        self._offsets = np.zeros(1, dtype='<u8') if offsets is None else offsets
+        self._blob = blob
+        self._appended = []
+
+    @staticmethod
+    def file_paths(file_path):
+        root = os.path.splitext(file_path)[0]
+        return f"{root}.offsets.npy", f"{root}.strings"
+
+    @classmethod
+    def exists(cls, file_path):
+        return all(os.path.exists(path) for path in cls.file_paths(file_path))
+
+    @classmethod
+    def load(cls, file_path):
+        offsets_file_path, strings_file_path = cls.file_paths(file_path)
+        offsets = np.load(offsets_file_path, mmap_mode='r')
+        # np.memmap refuses empty files.
+        blob = np.memmap(strings_file_path, dtype=np.uint8, mode='r') if os.path.getsize(strings_file_path) else b''
+        return cls(offsets, blob)
+
+    @staticmethod
+    def write(file_path, strings):
+        # The blob is streamed to disk; only the offsets are collected in memory.
+        offsets_file_path, strings_file_path = StringTable.file_paths(file_path)
+        offsets = [0]
+        with atomic_write(strings_file_path) as strings_file:
+            for string in strings:
+                data = string.encode('utf-8')
+                strings_file.write(data)
+                offsets.append(offsets[-1] + len(data))
+
+        with atomic_write(offsets_file_path) as offsets_file:
+            np.save(offsets_file, np.asarray(offsets, dtype='<u8'))
+
+    def __len__(self):
+        return len(self._offsets) - 1 + len(self._appended)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        stored_rows = len(self._offsets) - 1
+        if row >= stored_rows:
+            return self._appended[row - stored_rows]
+        return bytes(self._blob[int(self._offsets[row]):int(self._offsets[row + 1])]).decode('utf-8')
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def extended(self, strings):
+        table = StringTable(self._offsets, self._blob)
+        table._appended = self._appended + list(strings)
+        return table
@@ -0,0 +1,14 @@
+import asyncio
+
+
+async def to_thread_with_warnings(function, *args, warnings_fn=None, **kwargs):
+    # asyncio.to_thread for functions that take warnings_fn. Streamlit drops messages given outside the script's
+    # thread, so the worker's warnings are collected and passed to warnings_fn once it returns, on the thread
+    # running the event loop.
+    warnings = []
+    try:
+        return await asyncio.to_thread(function, *args, warnings_fn=warnings.append if warnings_fn else None,
+                                       **kwargs)
+    finally:
+        for message in warnings:
+            warnings_fn(message)
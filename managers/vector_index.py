@@ -0,0 +1,293 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from managers.skill_selection import top_k_indices
+from managers.atomic_file import atomic_write
+from constants import VECTOR_INDEX_BACKEND, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, HNSW_SAVE_EVERY, \
+    RERANK_CANDIDATES_FACTOR, SEARCH_SHARDS, MIN_ROWS_PER_SEARCH_SHARD
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class VectorIndex(ABC):
+    """Nearest-neighbour search over the rows of one ``EmbeddingStore``.
+
+    ``search`` returns ``(row, score)`` pairs ordered by decreasing dot-product
+    score, skipping tombstoned rows. ``search_by_type`` takes the number of results
+    wanted per type code and returns those pairs for every type.
+
+    A search reads the store through one ``StoreSnapshot``, the one passed in or
+    else the current one; callers map the rows back to titles with the same snapshot.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def _snapshot(self, snapshot):
+        return self.store.snapshot() if snapshot is None else snapshot
+
+    @abstractmethod
+    def search(self, query, top_k, snapshot=None):
+        pass
+
+    def search_many(self, queries, top_k, snapshot=None):
+        snapshot = self._snapshot(snapshot)
+        return [self.search(query, top_k, snapshot) for query in queries]
+
+    @abstractmethod
+    def search_by_type(self, query, top_k_by_type, snapshot=None):
+        pass
+
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def search_pool():
+    # Shared by all indexes; NumPy releases the GIL while scoring, so the shards run in parallel.
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=SEARCH_SHARDS, thread_name_prefix='vector-search')
+        return _search_pool
+
+
+class ExactIndex(VectorIndex):
+    """Brute-force search over every row of the store.
+
+    With ``shards`` above 1 the rows are split into contiguous ranges that are
+    scored in the search thread pool; each range keeps only its own top-k and the
+    ranges are merged afterwards, with ties going to the lower row as without
+    sharding. Every range is scored against the search's snapshot, so a refresh
+    in another thread while the ranges are scored cannot mix two generations.
+    """
+
+    def __init__(self, store, shards=SEARCH_SHARDS):
+        super().__init__(store)
+        self.shards = shards
+
+    def search(self, query, top_k, snapshot=None):
+        return self.search_many([query], top_k, snapshot)[0]
+
+    def search_many(self, queries, top_k, snapshot=None):
+        snapshot = self._snapshot(snapshot)
+        candidates = self._candidates(snapshot, queries, {None: self._shortlist_size(top_k)})
+        return [self._results(snapshot, query, *query_candidates[None], top_k)
+                for query, query_candidates in zip(queries, candidates)]
+
+    def search_by_type(self, query, top_k_by_type, snapshot=None):
+        # One scan of the whole store; every type masks out the rows of the others.
+        snapshot = self._snapshot(snapshot)
+        candidates = self._candidates(snapshot, [query], {type_code: self._shortlist_size(top_k)
+                                                          for type_code, top_k in top_k_by_type.items()})[0]
+        return {type_code: self._results(snapshot, query, *candidates[type_code], top_k)
+                for type_code, top_k in top_k_by_type.items()}
+
+    def _shortlist_size(self, top_k):
+        # Compact scores are only good enough to shortlist RERANK_CANDIDATES_FACTOR times more rows.
+        return top_k * RERANK_CANDIDATES_FACTOR if self.store.quantized else top_k
+
+    def _candidates(self, snapshot, queries, top_k_by_key):
+        # For every query, the rows and scores of the best rows per key, where the key None ranks all rows
+        # and a type code only the rows of that type.
+        total_rows = len(snapshot)
+        types = snapshot.types() if any(key is not None for key in top_k_by_key) else None
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+
+        def shard_candidates(start, stop):
+            shard_results = []
+            for scores in snapshot.scores(queries.T, start, stop).T:
+                query_results = {}
+                for key, top_k in top_k_by_key.items():
+                    key_scores = scores if key is None else np.where(types[start:stop] == key, scores, -np.inf)
+                    best = top_k_indices(key_scores, top_k)
+                    query_results[key] = (best + start, key_scores[best])
+                shard_results.append(query_results)
+            return shard_results
+
+        shard_count = max(1, min(self.shards, total_rows // MIN_ROWS_PER_SEARCH_SHARD))
+        if shard_count == 1:
+            return shard_candidates(0, total_rows)
+        bounds = np.linspace(0, total_rows, shard_count + 1).astype(int)
+        shards = list(search_pool().map(shard_candidates, bounds[:-1], bounds[1:]))
+
+        # Shards are concatenated in row order, so ties across shards still go to the lower row.
+        merged = []
+        for query_shards in zip(*shards):
+            query_results = {}
+            for key, top_k in top_k_by_key.items():
+                rows = np.concatenate([shard[key][0] for shard in query_shards])
+                scores = np.concatenate([shard[key][1] for shard in query_shards])
+                best = top_k_indices(scores, top_k)
+                query_results[key] = (rows[best], scores[best])
+            merged.append(query_results)
+        return merged
+
+    def _results(self, snapshot, query, rows, scores, top_k):
+        # rows and scores are ordered by decreasing score; rows that are masked out score -inf.
+        if not self.store.quantized:
+            return [(int(row), float(score)) for row, score in zip(rows, scores) if score > -np.inf]
+
+        # Re-rank the shortlist at full precision. Masked rows must not be brought back by the exact scores.
+        rows = rows[scores > -np.inf]
+        exact_scores = snapshot.exact_scores(query, rows)
+        best = top_k_indices(exact_scores, top_k)
+        return [(int(rows[i]), float(exact_scores[i])) for i in best if exact_scores[i] > -np.inf]
+
+
+class HNSWIndex(VectorIndex):
+    """Approximate search with an hnswlib graph persisted next to the store files.
+
+    The graph is labelled with store row ids. Rows appended to the store are added
+    on the next search, tombstones are marked deleted, and the graph is rebuilt
+    when a compaction renumbers the rows. Searches from several threads take turns,
+    since updating the graph and setting ``ef`` are not thread-safe. A search whose
+    snapshot is older than the graph drops the rows the snapshot does not have, or
+    scans the snapshot in full when the graph already belongs to a later generation.
+    """
+
+    def __init__(self, store):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the 'hnsw' vector index backend.")
+        super().__init__(store)
+        base_path = os.path.splitext(store.embeddings_file_path)[0]
+        self.index_file_path = f"{base_path}.hnsw"
+        self.meta_file_path = f"{base_path}.hnsw.json"
+        self._index = None
+        self._generation = None
+        self._indexed_rows = 0
+        self._deleted = set()
+        self._unsaved_rows = 0
+        self._lock = threading.Lock()
+
+    def _new_index(self, snapshot, max_elements):
+        index = hnswlib.Index(space='ip', dim=snapshot.dim)
+        index.init_index(max_elements=max_elements, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        return index
+
+    def _load(self, snapshot):
+        if not (os.path.exists(self.index_file_path) and os.path.exists(self.meta_file_path)):
+            return False
+        with open(self.meta_file_path, encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        if meta['generation'] != snapshot.version or meta['indexed_rows'] > len(snapshot):
+            return False
+
+        index = hnswlib.Index(space='ip', dim=snapshot.dim)
+        index.load_index(self.index_file_path, max_elements=max(meta['indexed_rows'], 1))
+        self._index = index
+        self._indexed_rows = meta['indexed_rows']
+        self._deleted = set(meta['deleted'])
+        return True
+
+    def _save(self):
+        with atomic_write(self.index_file_path, fsync=False) as index_file:
+            self._index.save_index(index_file.name)
+
+        meta = {'generation': self._generation, 'indexed_rows': self._indexed_rows,
+                'deleted': sorted(self._deleted)}
+        with atomic_write(self.meta_file_path, 'w', encoding='utf-8', fsync=False) as meta_file:
+            json.dump(meta, meta_file)
+        self._unsaved_rows = 0
+
+    def _sync(self, snapshot):
+        # Brings the graph up to the snapshot. Returns False, leaving the graph alone, when it already belongs
+        # to a later generation than the snapshot.
+        total_rows = len(snapshot)
+        if self._index is None or self._generation != snapshot.version:
+            if self._generation is not None and snapshot.version < self._generation:
+                return False
+            if not self._load(snapshot):
+                self._index = self._new_index(snapshot, max(total_rows, 1))
+                self._indexed_rows = 0
+                self._deleted = set()
+                self._unsaved_rows = HNSW_SAVE_EVERY
+            self._generation = snapshot.version
+
+        if total_rows > self._indexed_rows:
+            if total_rows > self._index.get_max_elements():
+                self._index.resize_index(max(total_rows, 2 * self._index.get_max_elements()))
+            self._index.add_items(snapshot.rows(self._indexed_rows, total_rows),
+                                  np.arange(self._indexed_rows, total_rows))
+            self._unsaved_rows += total_rows - self._indexed_rows
+            self._indexed_rows = total_rows
+
+        for row in snapshot.deleted - self._deleted:
+            self._index.mark_deleted(row)
+            self._deleted.add(row)
+
+        if self._unsaved_rows >= HNSW_SAVE_EVERY:
+            self._save()
+        return True
+
+    def _knn_query(self, snapshot, queries, top_k, filter=None):
+        # The graph's rows and distances, or None where a full scan of the snapshot has to answer instead.
+        with self._lock:
+            if not self._sync(snapshot):
+                return None
+            self._index.set_ef(max(HNSW_EF_SEARCH, top_k))
+            try:
+                return self._index.knn_query(np.asarray(queries, dtype=np.float32), k=top_k, filter=filter)
+            except RuntimeError:
+                # hnswlib gives up when too few live neighbours are reachable.
+                return None
+
+    def search(self, query, top_k, snapshot=None):
+        return self.search_many([query], top_k, snapshot)[0]
+
+    def search_many(self, queries, top_k, snapshot=None):
+        snapshot = self._snapshot(snapshot)
+        top_k = min(top_k, snapshot.count())
+        if top_k <= 0:
+            return [[] for _ in queries]
+
+        result = self._knn_query(snapshot, queries, top_k)
+        if result is None:
+            return ExactIndex(self.store).search_many(queries, top_k, snapshot)
+
+        # For the inner-product space hnswlib reports 1 - score as the distance. Rows added by a later
+        # snapshot than this one may already be in the graph.
+        return [[(int(row), 1.0 - float(distance)) for row, distance in zip(query_rows, query_distances)
+                 if snapshot.is_alive(int(row))]
+                for query_rows, query_distances in zip(*result)]
+
+    def search_by_type(self, query, top_k_by_type, snapshot=None):
+        # One graph serves every type; each query only accepts rows of its type.
+        snapshot = self._snapshot(snapshot)
+        types = snapshot.types()
+        live_counts = np.bincount(types[snapshot.alive()], minlength=256)
+        results = {}
+        for type_code, top_k in top_k_by_type.items():
+            top_k = min(top_k, int(live_counts[type_code]))
+            if top_k <= 0:
+                results[type_code] = []
+                continue
+
+            result = self._knn_query(snapshot, query, top_k,
+                                     lambda row, type_code=type_code: row < len(types) and types[row] == type_code)
+            if result is None:
+                results[type_code] = ExactIndex(self.store).search_by_type(
+                    query, {type_code: top_k}, snapshot)[type_code]
+                continue
+            rows, distances = result
+            results[type_code] = [(int(row), 1.0 - float(distance)) for row, distance in zip(rows[0], distances[0])
+                                  if snapshot.is_alive(int(row))]
+        return results
+
+
+VECTOR_INDEX_BACKENDS = {
+    'exact': ExactIndex,
+    'hnsw': HNSWIndex,
+}
+
+
+def create_vector_index(store, backend=VECTOR_INDEX_BACKEND):
+    if backend not in VECTOR_INDEX_BACKENDS:
+        raise ValueError(f"Unknown vector index backend: {backend}")
+    return VECTOR_INDEX_BACKENDS[backend](store)
@@ -0,0 +1,12 @@
+# MunJobProject/reconcile_embeddings.py
+# Brings the skill embeddings in line with the skill nodes in the graph:
+#   python reconcile_embeddings.py
+
+from managers import DatabaseManager
+
+if __name__ == '__main__':
+    database_manager = DatabaseManager()
+    report = database_manager.skill_manager.reconcile_embeddings()
+    for change in ['added', 'retyped', 'deleted', 'skipped']:
+        for title in report[change]:
+            print(f"{change}: {title}")
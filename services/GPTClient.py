@@ -1,18 +1,122 @@
+import asyncio
 import openai
 import json
 import os
+import time
 from openai import OpenAIError
+from services.response_cache import ResponseCache
+from services.rate_limiter import RateLimiter
+from services.token_budget import TokenUsageLog, count_tokens, truncate_to_tokens, fit_ranked
+from services.translation_memory import TranslationMemory, split_segments
+from constants import GPT_RESPONSE_CACHE_PATH, GPT_RESPONSE_CACHE_TTL, GPT_RESPONSE_CACHE_BYTES, \
+    GPT_MAX_CONCURRENT_REQUESTS, GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE, GPT_COMPLETION_TOKENS_ESTIMATE, \
+    GPT_MAX_RETRIES, GPT_RETRY_BASE_DELAY, GPT_RETRY_MAX_DELAY, GPT_PROMPT_TOKEN_BUDGETS, GPT_USAGE_LOG_PATH, \
+    TRANSLATION_MEMORY_PATH, TRANSLATE_MANY_BATCH_SIZE, GPT_RATE_LIMITS, GPT_MODEL_ROUTES
+
+# Structured output of prepare_course: one translation per numbered sentence of the course, in input order, and the
+# skills the course teaches
+COURSE_PREPARATION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "course_preparation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "translations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "index": {"type": "integer"},
+                            "translation": {"type": "string"}
+                        },
+                        "required": ["index", "translation"],
+                        "additionalProperties": False
+                    }
+                },
+                "skills": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {"type": "string"},
+                            "description": {"type": "string"}
+                        },
+                        "required": ["title", "description"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["translations", "skills"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Structured output of translate_many: one translation per numbered input string, in input order
+TRANSLATIONS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "translations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "translations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "index": {"type": "integer"},
+                            "translation": {"type": "string"}
+                        },
+                        "required": ["index", "translation"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["translations"],
+            "additionalProperties": False
+        }
+    }
+}
 
 
 class GPTClient:
-    def __init__(self, model="gpt-4o"):
+    def __init__(self, model="gpt-4o", routes=GPT_MODEL_ROUTES):
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OpenAI API key not found in environment variables.")
-        self.client = openai.OpenAI(api_key=self.api_key)
+        # Retries are left to the rate limiter, which knows about every request in flight
+        self.client = openai.OpenAI(api_key=self.api_key, max_retries=0)
         self.model = model
+        self.routes = routes
+        self.response_cache = ResponseCache(GPT_RESPONSE_CACHE_PATH, GPT_RESPONSE_CACHE_TTL, GPT_RESPONSE_CACHE_BYTES)
+        self.rate_limiters = {}
+        self.usage_log = TokenUsageLog(GPT_USAGE_LOG_PATH)
+        self.translation_memory = TranslationMemory(TRANSLATION_MEMORY_PATH)
+
+    def route(self, method, response_format=None):
+        # The model and the generation parameters of a method's requests
+        parameters = dict(self.routes.get(method, {}))
+        model = parameters.pop('model', self.model)
+        if response_format:
+            parameters['response_format'] = response_format
+        return model, parameters
 
-    def chat(self, system_message, user_message, additional_messages=None, warnings_fn=None):
+    def rate_limiter(self, model):
+        # One limiter per model, since the API counts every model's requests separately
+        if model not in self.rate_limiters:
+            requests_per_minute, tokens_per_minute = GPT_RATE_LIMITS.get(
+                model, (GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE))
+            self.rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute,
+                                                    GPT_COMPLETION_TOKENS_ESTIMATE, GPT_MAX_RETRIES,
+                                                    GPT_RETRY_BASE_DELAY, GPT_RETRY_MAX_DELAY)
+        return self.rate_limiters[model]
+
+    @staticmethod
+    def build_messages(system_message, user_message, additional_messages=None):
         messages = [
             {"role": "system", "content": system_message},
             {"role": "user", "content": user_message}
@@ -20,19 +124,74 @@ class GPTClient:
 
         if additional_messages:
             messages.extend(additional_messages)
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages
-            )
-            print("RESPONSE:", response.choices[0].message.content)
+        return messages
+
+    def cached_response(self, cache_key, use_cache, method, model, started):
+        if not use_cache:
+            return None
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            print("CACHED RESPONSE:", cached_response)
+            self.usage_log.record(method, model, 0, 0, time.monotonic() - started, cached=True)
+        return cached_response
+
+    def chat(self, system_message, user_message, additional_messages=None, warnings_fn=None, use_cache=True,
+             response_format=None, method="chat"):
+        # use_cache=False asks the API again and stores the new answer in place of the cached one;
+        # method names the caller in the usage log and picks the model and parameters from the routes
+        started = time.monotonic()
+        messages = self.build_messages(system_message, user_message, additional_messages)
+        model, parameters = self.route(method, response_format)
+        cache_key = self.response_cache.key(model, messages, parameters)
+        cached_response = self.cached_response(cache_key, use_cache, method, model, started)
+        if cached_response is not None:
+            return cached_response
+
+        rate_limiter = self.rate_limiter(model)
+        estimated_tokens = rate_limiter.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            rate_limiter.acquire(estimated_tokens)
+            try:
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    **parameters
+                )
+                break
+            except OpenAIError as e:
+                delay = self.failed_attempt(e, attempt, rate_limiter, estimated_tokens, warnings_fn)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+                attempt += 1
 
-            return response.choices[0].message.content
+        return self.handle_response(response, cache_key, estimated_tokens, method, model, started)
 
-        except OpenAIError as e:
+    @staticmethod
+    def failed_attempt(error, attempt, rate_limiter, estimated_tokens, warnings_fn=None):
+        # Seconds to wait before trying again, or None after warning about an error that is final. Either way
+        # the attempt's token reservation is given back, so only the attempt that succeeds keeps one.
+        rate_limiter.release(estimated_tokens)
+        delay = rate_limiter.retry_delay(error, attempt)
+        if delay is None:
             if warnings_fn:
-                warnings_fn(f"Failed to generate response: {e}")
+                warnings_fn(f"Failed to generate response: {error}")
             return None
+        print(f"Request failed ({error}); retrying in {delay:.1f} s.")
+        return delay
+
+    def handle_response(self, response, cache_key, estimated_tokens, method, model, started):
+        usage = response.usage
+        self.rate_limiter(model).settle(estimated_tokens, usage)
+        self.usage_log.record(method, model, usage.prompt_tokens if usage else 0,
+                              usage.completion_tokens if usage else 0, time.monotonic() - started)
+        print("RESPONSE:", response.choices[0].message.content)
+
+        content = response.choices[0].message.content
+        if content is not None:
+            self.response_cache.put(cache_key, content)
+        return content
 
     @staticmethod
     def remove_quotes(text, warnings_fn=None):
@@ -41,49 +200,226 @@ class GPTClient:
             return " ".join(text.strip().split())
         return ""
 
-    def generate_skill_description_english(self, skill_title, course_and_profession_info, warnings_fn=None):
+    def generate_skill_description_english(self, skill_title, course_and_profession_info, warnings_fn=None,
+                                           use_cache=True):
         # Remove any quotation marks for cleaner input processing.
         skill_title = self.remove_quotes(skill_title)
-        course_and_profession_info = self.remove_quotes(course_and_profession_info)
+        course_and_profession_info = truncate_to_tokens(self.remove_quotes(course_and_profession_info),
+                                                        GPT_PROMPT_TOKEN_BUDGETS['generate_skill_description'])
         # Define the AI's role clearly as an expert in generating detailed skill descriptions using the provided contextual information.
         system_message = "You are an expert tasked with creating detailed skill descriptions in English."
         # Direct the AI to provide a description that incorporates details about the courses that teach this skill and the professions that require it.
         user_message = f"Generate a detailed and concise description for the skill: '{skill_title}', using the additional information if provided about the courses and professions involved. Additional information {course_and_profession_info} Limit the response to three sentences."
-        return self.chat(system_message, user_message)
+        return self.chat(system_message, user_message, use_cache=use_cache,
+                         method="generate_skill_description_english")
 
-    def generate_skill_description_finnish(self, skill_title, course_and_profession_info, warnings_fn=None):
+    def generate_skill_description_finnish(self, skill_title, course_and_profession_info, warnings_fn=None,
+                                           use_cache=True):
         skill_title = self.remove_quotes(skill_title)
-        course_and_profession_info = self.remove_quotes(course_and_profession_info)
+        course_and_profession_info = truncate_to_tokens(self.remove_quotes(course_and_profession_info),
+                                                        GPT_PROMPT_TOKEN_BUDGETS['generate_skill_description'])
         system_message = "As a Finnish-speaking expert, generate a detailed yet concise description for the following skill."
         user_message = f"Skill: {skill_title}. Relevant courses and professions: {course_and_profession_info}. Please provide the description in Finnish, up to three sentences."
-        return self.chat(system_message, user_message)
+        return self.chat(system_message, user_message, use_cache=use_cache,
+                         method="generate_skill_description_finnish")
+
+    def translate(self, text, target_language="English", warnings_fn=None, use_cache=True):
+        return self.translate_many([text], target_language, warnings_fn, use_cache)[0]
+
+    def translate_many(self, texts, target_language="English", warnings_fn=None, use_cache=True):
+        # Translations of texts in the same order, None for a text that could not be translated. Only the
+        # sentences the translation memory has not seen are sent, in batches from translation_batches.
+        # use_cache=False translates every sentence again and replaces what the memory had for it.
+        segments_by_text, translations, missing = self.recall_translations(texts, target_language, use_cache)
+        for batch in self.translation_batches(missing):
+            self.translate_segments(batch, translations, target_language, warnings_fn, use_cache)
+        return self.join_translations(segments_by_text, translations)
+
+    @staticmethod
+    def translation_batches(segments):
+        # Consecutive segments, at most TRANSLATE_MANY_BATCH_SIZE of them and the translate token budget to a
+        # batch; a segment over the budget on its own goes alone
+        budget = GPT_PROMPT_TOKEN_BUDGETS['translate']
+        batch, batch_tokens = [], 0
+        for segment in segments:
+            tokens = count_tokens(segment)
+            if batch and (len(batch) == TRANSLATE_MANY_BATCH_SIZE or batch_tokens + tokens > budget):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(segment)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def translate_segments(self, segments, translations, target_language, warnings_fn=None, use_cache=True):
+        response = self.chat(*self.segments_translation_prompt(segments, target_language), warnings_fn=warnings_fn,
+                             use_cache=use_cache, response_format=self.segments_translation_format(segments),
+                             method="translate")
+        segment_translations = self.parse_segment_translations(segments, response)
+        if segment_translations is not None:
+            self.memorize_translations(segments, segment_translations, translations, target_language)
+        elif response is not None and len(segments) > 1:
+            # The answer lost or reordered strings; halves are more likely to come back intact
+            half = len(segments) // 2
+            self.translate_segments(segments[:half], translations, target_language, warnings_fn, use_cache)
+            self.translate_segments(segments[half:], translations, target_language, warnings_fn, use_cache)
+
+    def recall_translations(self, texts, target_language, use_cache=True):
+        # The segments of every text, the translations memory has for them and the segments it is missing
+        segments_by_text = [
+            split_segments(truncate_to_tokens(self.remove_quotes(text), GPT_PROMPT_TOKEN_BUDGETS['translate']))
+            for text in texts]
+        segments = list(dict.fromkeys(segment for text_segments in segments_by_text for segment in text_segments))
+        translations = self.translation_memory.get_many(segments, target_language) if use_cache else {}
+        return segments_by_text, translations, [segment for segment in segments if segment not in translations]
+
+    def memorize_translations(self, segments, segment_translations, translations, target_language):
+        self.translation_memory.put_many(segments, segment_translations, target_language)
+        translations.update(zip(segments, segment_translations))
 
-    def translate(self, text, target_language="English", warnings_fn=None):
+    @staticmethod
+    def join_translations(segments_by_text, translations):
+        return [" ".join(translations[segment] for segment in text_segments)
+                if all(segment in translations for segment in text_segments) else None
+                for text_segments in segments_by_text]
+
+    @classmethod
+    def segments_translation_prompt(cls, segments, target_language="English"):
+        if len(segments) == 1:
+            return cls.translate_prompt(segments[0], target_language)
+        system_message = "You are a professional translator. Provide a direct translation."
+        user_message = (
+            f"Translate the text of every numbered string below to {target_language}. Answer with exactly one "
+            "translation per string, keeping its index and the order of the strings. Provide only translation. "
+            "No comments from your side.\n"
+            + json.dumps([{"index": index, "text": segment} for index, segment in enumerate(segments, start=1)],
+                         ensure_ascii=False)
+        )
+        return system_message, user_message
+
+    @staticmethod
+    def segments_translation_format(segments):
+        return TRANSLATIONS_FORMAT if len(segments) > 1 else None
+
+    @staticmethod
+    def parse_segment_translations(segments, response):
+        # Translations of segments in order, or None unless the answer has exactly one per segment in order
+        if response is None:
+            return None
+        if len(segments) == 1:
+            return [" ".join(response.split())]
+        try:
+            items = json.loads(response)['translations']
+            if [item['index'] for item in items] != list(range(1, len(segments) + 1)):
+                return None
+            return [" ".join(item['translation'].split()) for item in items]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def translate_prompt(cls, text, target_language="English"):
         # Removes any non-essential conversational elements or personalizations.
-        text = self.remove_quotes(text)
+        text = truncate_to_tokens(cls.remove_quotes(text), GPT_PROMPT_TOKEN_BUDGETS['translate'])
         # Direct, professional instruction aimed specifically at translation.
         system_message = "You are a professional translator. Provide a direct translation."
         # Request a literal translation of the text to the specified language.
         user_message = f"Translate the following text to {target_language}: '{text}'. Provide only translation.No comments from your side."
-        return self.chat(system_message, user_message)
+        return system_message, user_message
 
-    def extract_skills_from_course_description(self, description, warnings_fn=None):
+    def extract_skills_from_course_description(self, description, warnings_fn=None, use_cache=True):
+        return self.chat(*self.course_skills_prompt(description), use_cache=use_cache,
+                         method="extract_skills_from_course_description")
+
+    @classmethod
+    def course_skills_prompt(cls, description):
         # Remove any quotation marks from the course description for clearer input.
-        description = self.remove_quotes(description)
+        description = truncate_to_tokens(cls.remove_quotes(description), GPT_PROMPT_TOKEN_BUDGETS['extract_skills'])
         # Clearly define the task for the AI, focusing on identifying skills gained from the course.
         system_message = "You are a learning and development expert. Your task is to identify skills that are developed by taking this course."
         # Ask the AI to list the skills acquired from the course and provide a concise description for each skill.
         user_message = f"From the following course description, identify and describe each skill that will be acquired by completing the course: '{description}' Please provide a brief description for each identified skill."
-        return self.chat(system_message, user_message)
+        return system_message, user_message
+
+    def prepare_course(self, title_fi, description_fi, warnings_fn=None, use_cache=True):
+        # Translation and skill extraction in one structured call; None if it fails. The title and description go
+        # through the translation memory first, so the call only translates the sentences the memory is missing.
+        segments_by_text, translations, missing = self.recall_translations([title_fi, description_fi], "English",
+                                                                           use_cache)
+        response = self.chat(*self.course_preparation_prompt(segments_by_text, translations, missing),
+                             warnings_fn=warnings_fn, use_cache=use_cache, response_format=COURSE_PREPARATION_FORMAT,
+                             method="prepare_course")
+        return self.finish_course_preparation(segments_by_text, translations, missing, response, warnings_fn)
+
+    @classmethod
+    def course_preparation_prompt(cls, segments_by_text, translations, missing):
+        # The course sentence by sentence: the sentences the translation memory has are given in English, the
+        # missing ones in Finnish after the number their translation is expected under
+        numbers = {segment: number for number, segment in enumerate(missing, start=1)}
+
+        def course_text(text_segments):
+            return " ".join(f"[{numbers[segment]}] {segment}" if segment in numbers else translations[segment]
+                            for segment in text_segments)
+
+        title, description = (course_text(text_segments) for text_segments in segments_by_text)
+        system_message = "You are a professional translator and a learning and development expert."
+        user_message = (
+            "Parts of the following course title and description are already in English. Translate every sentence "
+            "marked with a number in square brackets to English, with exactly one translation per number, in order. "
+            "Provide only the translations.\n"
+            "Then identify each skill that will be acquired by completing the course and give a brief description "
+            "for each identified skill.\n"
+            f"Course title: '{title}'\n"
+            f"Course description: '{description}'"
+        )
+        return system_message, user_message
 
-    def extract_skills_from_profession_description(self, description, warnings_fn=None):
-        description = self.remove_quotes(description)
+    def finish_course_preparation(self, segments_by_text, translations, missing, response, warnings_fn=None):
+        # (title, description, skills), with the skills as the numbered list extract_skills_from_course_description
+        # produces. The new translations are added to the memory.
+        prepared = self.parse_course_preparation(missing, response, warnings_fn)
+        if prepared is None:
+            return None
+        segment_translations, skills = prepared
+        self.memorize_translations(missing, segment_translations, translations, "English")
+        title, description = self.join_translations(segments_by_text, translations)
+        return title, description, skills
+
+    @staticmethod
+    def parse_course_preparation(segments, response, warnings_fn=None):
+        # The translations of segments in order and the skills, or None unless the answer has both
+        if response is None:
+            return None
+        try:
+            course = json.loads(response)
+            if [item['index'] for item in course['translations']] != list(range(1, len(segments) + 1)):
+                if warnings_fn:
+                    warnings_fn("GPT did not translate every sentence of the course. Course preparation error.")
+                return None
+            skills = "\n".join(f"{number}. **{skill['title']}**: {skill['description']}"
+                               for number, skill in enumerate(course['skills'], start=1))
+            return [" ".join(item['translation'].split()) for item in course['translations']], skills
+        except (json.JSONDecodeError, KeyError, TypeError):
+            if warnings_fn:
+                warnings_fn("Failed to decode JSON response from GPT. Course preparation error.")
+            return None
+
+    def extract_skills_from_profession_description(self, description, warnings_fn=None, use_cache=True):
+        description = truncate_to_tokens(self.remove_quotes(description), GPT_PROMPT_TOKEN_BUDGETS['extract_skills'])
         system_message = "You are a career development expert. Your task is to identify skills that are essential for the given profession."
         user_message = f"From the following profession description, identify and describe each skill that is essential for performing well in this profession: '{description}' Please provide a brief description for each identified skill. Only skills with very short descriptions. No comments from your side."
-        return self.chat(system_message, user_message)
+        return self.chat(system_message, user_message, use_cache=use_cache,
+                         method="extract_skills_from_profession_description")
 
-    def match_skills_for_course(self, filtered_skills, combined_description, warnings_fn=None):
-        combined_description = self.remove_quotes(combined_description)
+    def match_skills_for_course(self, filtered_skills, combined_description, warnings_fn=None, use_cache=True):
+        response = self.chat(*self.course_matching_prompt(filtered_skills, combined_description),
+                             warnings_fn=warnings_fn, use_cache=use_cache, method="match_skills_for_course")
+        return self.parse_skill_matches(
+            response, "Failed to decode JSON response from gpt. Courses skill matching error.", warnings_fn)
+
+    @classmethod
+    def course_matching_prompt(cls, filtered_skills, combined_description):
+        filtered_skills, combined_description = cls.fit_matching_context(filtered_skills,
+                                                                         cls.remove_quotes(combined_description))
         # filtered_skills = self.remove_quotes(filtered_skills)
         system_message = "You are a professional experienced learning and development expert."
         user_message = (
@@ -99,20 +435,46 @@ class GPTClient:
             f"Common skills list: {json.dumps(filtered_skills)}.\nProgram Combined Description: {combined_description}"
 
         )
+        return system_message, user_message
+
+    @staticmethod
+    def fit_matching_context(filtered_skills, description):
+        # The description gets at most a third of the budget and the skill list what is left; filter_skills
+        # ranks the list best first across all types, so the weakest skills are the ones dropped
+        budget = GPT_PROMPT_TOKEN_BUDGETS['match_skills']
+        description = truncate_to_tokens(description, budget // 3)
+        return fit_ranked(filtered_skills, budget - count_tokens(description)), description
 
-        response = self.chat(system_message, user_message)
+    @staticmethod
+    def parse_skill_matches(response, error_message, warnings_fn=None):
+        # None when no matches could be had, unlike an empty list, which means GPT matched nothing
+        if response is None:
+            # chat already reported to warnings_fn why the request failed
+            return None
+
+        # Clean the response by removing any unwanted formatting
         clean_answer = response.replace("```json", "").replace("```", "").strip()
 
+        # Attempt to parse the response as JSON and handle any errors
         try:
             return json.loads(clean_answer)
         except json.JSONDecodeError:
             if warnings_fn:
-                warnings_fn("Failed to decode JSON response from gpt. Courses skill matching error.")
-            return []
+                warnings_fn(error_message)
+            return None
 
-    def match_skills_for_profession(self, filtered_skills, profession_description, warnings_fn=None):
+    def match_skills_for_profession(self, filtered_skills, profession_description, warnings_fn=None, use_cache=True):
+        # Send the messages to the GPT model and get the response
+        response = self.chat(*self.profession_matching_prompt(filtered_skills, profession_description),
+                             warnings_fn=warnings_fn, use_cache=use_cache, method="match_skills_for_profession")
+        return self.parse_skill_matches(
+            response, "Failed to decode JSON response from GPT. Profession skill matching error.", warnings_fn)
+
+    @classmethod
+    def profession_matching_prompt(cls, filtered_skills, profession_description):
         # Clean the profession description by removing quotes
-        profession_description = self.remove_quotes(profession_description)
+        filtered_skills, profession_description = cls.fit_matching_context(filtered_skills,
+                                                                           cls.remove_quotes(profession_description))
 
         # Define the system message for the GPT model
         system_message = (
@@ -133,17 +495,112 @@ class GPTClient:
             "[{\"extracted_skill\": \"skill_title\", \"common_skill\": \"matched_skill_or_new\"}, ...]\n"
             f"THE MAIN SKILL LIST: {filtered_skills}"
             f"THE PROFESSION'S DETAILED DESCRIPTION: {profession_description}")
+        return system_message, user_message
 
-        # Send the messages to the GPT model and get the response
-        response = self.chat(system_message, user_message)
 
-        # Clean the response by removing any unwanted formatting
-        clean_answer = response.replace("```json", "").replace("```", "").strip()
+class AsyncGPTClient:
+    """asyncio counterpart of ``GPTClient`` for bulk ingestion.
 
-        # Attempt to parse the response as JSON and handle any errors
-        try:
-            return json.loads(clean_answer)
-        except json.JSONDecodeError:
-            if warnings_fn:
-                warnings_fn("Failed to decode JSON response from GPT. Profession skill matching error.")
-            return []
+    Shares the prompts and the response cache of the wrapped client. At most
+    ``max_concurrent_requests`` requests are in flight at once. The underlying
+    HTTP client belongs to the event loop it was created in, so use one instance
+    per ``asyncio.run`` and close it, e.g. with ``async with``.
+    """
+
+    def __init__(self, gpt_client, max_concurrent_requests=GPT_MAX_CONCURRENT_REQUESTS):
+        self.gpt_client = gpt_client
+        self.client = openai.AsyncOpenAI(api_key=gpt_client.api_key, max_retries=0)
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.close()
+
+    async def chat(self, system_message, user_message, additional_messages=None, warnings_fn=None, use_cache=True,
+                   response_format=None, method="chat"):
+        started = time.monotonic()
+        gpt_client = self.gpt_client
+        messages = gpt_client.build_messages(system_message, user_message, additional_messages)
+        model, parameters = gpt_client.route(method, response_format)
+        cache_key = gpt_client.response_cache.key(model, messages, parameters)
+        cached_response = gpt_client.cached_response(cache_key, use_cache, method, model, started)
+        if cached_response is not None:
+            return cached_response
+
+        rate_limiter = gpt_client.rate_limiter(model)
+        estimated_tokens = rate_limiter.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await rate_limiter.acquire_async(estimated_tokens)
+                try:
+                    response = await self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        **parameters
+                    )
+                    break
+                except OpenAIError as e:
+                    delay = gpt_client.failed_attempt(e, attempt, rate_limiter, estimated_tokens, warnings_fn)
+                    if delay is None:
+                        return None
+            # Other requests may use the slot while this one backs off
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        return gpt_client.handle_response(response, cache_key, estimated_tokens, method, model, started)
+
+    async def translate(self, text, target_language="English", warnings_fn=None, use_cache=True):
+        return (await self.translate_many([text], target_language, warnings_fn, use_cache))[0]
+
+    async def translate_many(self, texts, target_language="English", warnings_fn=None, use_cache=True):
+        # Same as GPTClient.translate_many, with the batches of unseen sentences requested concurrently
+        gpt_client = self.gpt_client
+        segments_by_text, translations, missing = gpt_client.recall_translations(texts, target_language, use_cache)
+        await asyncio.gather(*(
+            self.translate_segments(batch, translations, target_language, warnings_fn, use_cache)
+            for batch in GPTClient.translation_batches(missing)))
+        return gpt_client.join_translations(segments_by_text, translations)
+
+    async def translate_segments(self, segments, translations, target_language, warnings_fn=None, use_cache=True):
+        response = await self.chat(*GPTClient.segments_translation_prompt(segments, target_language),
+                                   warnings_fn=warnings_fn, use_cache=use_cache,
+                                   response_format=GPTClient.segments_translation_format(segments), method="translate")
+        segment_translations = GPTClient.parse_segment_translations(segments, response)
+        if segment_translations is not None:
+            self.gpt_client.memorize_translations(segments, segment_translations, translations, target_language)
+        elif response is not None and len(segments) > 1:
+            half = len(segments) // 2
+            await asyncio.gather(
+                self.translate_segments(segments[:half], translations, target_language, warnings_fn, use_cache),
+                self.translate_segments(segments[half:], translations, target_language, warnings_fn, use_cache))
+
+    async def extract_skills_from_course_description(self, description, warnings_fn=None, use_cache=True):
+        return await self.chat(*GPTClient.course_skills_prompt(description), use_cache=use_cache,
+                               method="extract_skills_from_course_description")
+
+    async def prepare_course(self, title_fi, description_fi, warnings_fn=None, use_cache=True):
+        segments_by_text, translations, missing = self.gpt_client.recall_translations([title_fi, description_fi],
+                                                                                      "English", use_cache)
+        response = await self.chat(*GPTClient.course_preparation_prompt(segments_by_text, translations, missing),
+                                   warnings_fn=warnings_fn, use_cache=use_cache,
+                                   response_format=COURSE_PREPARATION_FORMAT, method="prepare_course")
+        return self.gpt_client.finish_course_preparation(segments_by_text, translations, missing, response,
+                                                         warnings_fn)
+
+    async def match_skills_for_course(self, filtered_skills, combined_description, warnings_fn=None,
+                                      use_cache=True):
+        response = await self.chat(*GPTClient.course_matching_prompt(filtered_skills, combined_description),
+                                   warnings_fn=warnings_fn, use_cache=use_cache, method="match_skills_for_course")
+        return GPTClient.parse_skill_matches(
+            response, "Failed to decode JSON response from gpt. Courses skill matching error.", warnings_fn)
+
+    async def match_skills_for_profession(self, filtered_skills, profession_description, warnings_fn=None,
+                                          use_cache=True):
+        response = await self.chat(*GPTClient.profession_matching_prompt(filtered_skills, profession_description),
+                                   warnings_fn=warnings_fn, use_cache=use_cache,
+                                   method="match_skills_for_profession")
+        return GPTClient.parse_skill_matches(
+            response, "Failed to decode JSON response from GPT. Profession skill matching error.", warnings_fn)
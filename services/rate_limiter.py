@@ -0,0 +1,116 @@
+import asyncio
+import random
+import threading
+import time
+from openai import APIConnectionError, APIStatusError
+from services.token_budget import count_tokens
+
+# statuses worth another attempt: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class TokenBucket:
+    """Allowance of ``capacity`` units per minute, refilled continuously.
+
+    ``reserve`` takes the units right away and returns how long the caller has to
+    wait before using them, so concurrent callers queue up in the order they
+    reserved instead of all retrying at once.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every request of a client.
+
+    Tokens are reserved from an estimate before a request is sent and settled
+    with the usage the API reports. A rate-limit response pauses all requests for
+    the time the API asks for.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, completion_tokens_estimate, max_retries,
+                 base_delay, max_delay):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.completion_tokens_estimate = completion_tokens_estimate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, messages):
+        # Prompt tokens plus room for the answer
+        return sum(count_tokens(message['content']) for message in messages) + self.completion_tokens_estimate
+
+    def reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            return max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now), self.paused_until - now)
+
+    def acquire(self, tokens):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def release(self, estimated_tokens):
+        # Gives back the tokens of a request that failed; a retry reserves them again
+        with self._lock:
+            self.tokens.refund(estimated_tokens)
+
+    def settle(self, estimated_tokens, usage):
+        # Gives back what the estimate over-reserved, or takes what it missed
+        if usage is None:
+            return
+        with self._lock:
+            self.tokens.refund(estimated_tokens - usage.total_tokens)
+
+    def retry_delay(self, error, attempt):
+        # Seconds to wait before attempt + 1, or None when the error is final
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, APIStatusError):
+            if error.status_code not in RETRYABLE_STATUS_CODES and error.status_code < 500:
+                return None
+        elif not isinstance(error, APIConnectionError):
+            return None
+
+        # Full jitter keeps clients that failed together from retrying together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+            with self._lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        return delay
+
+    @staticmethod
+    def retry_after(error):
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        try:
+            if 'retry-after-ms' in headers:
+                return float(headers['retry-after-ms']) / 1000
+            if 'retry-after' in headers:
+                return float(headers['retry-after'])
+        except ValueError:
+            # retry-after may also be an HTTP date; the backoff covers that case
+            pass
+        return None
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+
+class ResponseCache:
+    """Persistent cache of chat completions keyed by a hash of the model, the messages and the parameters.
+
+    Entries older than ``ttl`` seconds are never returned. When the stored responses
+    take more than ``max_bytes``, the least recently read ones are evicted.
+    """
+
+    def __init__(self, file_path, ttl, max_bytes):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, accessed REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(model, messages, parameters=None):
+        request = json.dumps({'model': model, 'messages': messages, 'parameters': parameters or {}},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            row = connection.execute("SELECT response FROM responses WHERE key = ? AND created >= ?",
+                                     (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now))
+            connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        # Least recently read first, until the rest fits
+        evicted = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# encoding of the gpt-4o model family; without tiktoken tokens are estimated from the length
+TOKEN_ENCODING = 'o200k_base'
+CHARACTERS_PER_TOKEN = 4
+
+_encoding = None
+
+
+def encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    return _encoding
+
+
+def count_tokens(text):
+    if tiktoken is None:
+        return -(-len(text) // CHARACTERS_PER_TOKEN)
+    return len(encoding().encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, budget):
+    # The longest beginning of text that fits in budget tokens
+    text = text or ""
+    if count_tokens(text) <= budget:
+        return text
+    if tiktoken is None:
+        cut = text[:budget * CHARACTERS_PER_TOKEN]
+        # Do not leave half a word behind
+        return cut.rsplit(None, 1)[0] if ' ' in cut else cut
+    return encoding().decode(encoding().encode(text, disallowed_special=())[:budget])
+
+
+def fit_ranked(items, budget):
+    # The longest prefix of items, ranked most relevant first, whose JSON list fits in budget tokens
+    fitted = []
+    used = 1
+    for item in items:
+        used += count_tokens(json.dumps(item)) + 1
+        if used > budget:
+            break
+        fitted.append(item)
+    return fitted
+
+
+class TokenUsageLog:
+    """Prompt and completion tokens and wall time of every GPT call.
+
+    Every call is appended to a JSON-lines file so that cost and latency can be
+    broken down by method later; ``summary`` totals the calls of this process.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.totals = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+
+    def record(self, method, model, prompt_tokens, completion_tokens, seconds, cached=False):
+        entry = {'time': time.time(), 'method': method, 'model': model, 'prompt_tokens': prompt_tokens,
+                 'completion_tokens': completion_tokens, 'seconds': round(seconds, 3), 'cached': cached}
+        with self._lock:
+            totals = self.totals.setdefault(method, {'calls': 0, 'cached_calls': 0, 'prompt_tokens': 0,
+                                                     'completion_tokens': 0, 'seconds': 0.0})
+            totals['calls'] += 1
+            totals['cached_calls'] += cached
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+            totals['seconds'] += seconds
+            with open(self.file_path, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps(entry) + '\n')
+
+    def summary(self):
+        with self._lock:
+            return {method: dict(totals) for method, totals in self.totals.items()}
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import re
+import sqlite3
+from contextlib import closing
+from constants import SQLITE_QUERY_CHUNK_SIZE
+
+# A sentence ends at ., ! or ? followed by a capital, a digit or an opening quote or bracket, so abbreviations
+# such as "esim. kurssi" stay in one segment
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-ZÅÄÖ0-9"“(])')
+
+
+def split_segments(text):
+    return [segment for segment in SENTENCE_END.split(" ".join(text.split())) if segment]
+
+
+def normalize_segment(segment):
+    # Case, spacing and the closing punctuation do not change a translation enough to translate again
+    return " ".join(segment.casefold().split()).rstrip('.!?:; ')
+
+
+class TranslationMemory:
+    """Persistent translations of text segments, looked up by exact and by normalized source text."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments "
+                "(exact_key TEXT PRIMARY KEY, normalized_key TEXT, source TEXT, translation TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS segments_normalized ON segments (normalized_key)")
+
+    @staticmethod
+    def key(text, target_language):
+        return hashlib.sha256(f"{target_language}\0{text}".encode('utf-8')).hexdigest()
+
+    def _select(self, connection, column, keys):
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), SQLITE_QUERY_CHUNK_SIZE):
+            chunk = key_list[start:start + SQLITE_QUERY_CHUNK_SIZE]
+            rows = connection.execute(
+                f"SELECT {column}, translation FROM segments WHERE {column} IN ({','.join('?' * len(chunk))})", chunk)
+            found.update(rows)
+        return found
+
+    def get_many(self, segments, target_language):
+        # Translations of the segments found in memory, by segment
+        exact_keys = {self.key(segment, target_language): segment for segment in segments}
+        with closing(sqlite3.connect(self.file_path)) as connection:
+            found = {exact_keys[key]: translation
+                     for key, translation in self._select(connection, 'exact_key', exact_keys).items()}
+            normalized_keys = {}
+            for segment in segments:
+                if segment not in found:
+                    normalized_keys.setdefault(self.key(normalize_segment(segment), target_language), []).append(
+                        segment)
+            for key, translation in self._select(connection, 'normalized_key', normalized_keys).items():
+                for segment in normalized_keys[key]:
+                    found[segment] = translation
+        return found
+
+    def put_many(self, segments, translations, target_language):
+        with closing(sqlite3.connect(self.file_path)) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO segments (exact_key, normalized_key, source, translation) VALUES (?, ?, ?, ?)",
+                [(self.key(segment, target_language), self.key(normalize_segment(segment), target_language), segment,
+                  translation) for segment, translation in zip(segments, translations)])
@@ -0,0 +1,9 @@
+# MunJobProject/translate_new_skill_titles.py
+# Fills in the Finnish titles of new skills, which are created without one:
+#   python translate_new_skill_titles.py
+
+from managers import DatabaseManager
+
+if __name__ == '__main__':
+    database_manager = DatabaseManager()
+    database_manager.skill_manager.translate_new_skill_titles()